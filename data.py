@@ -1,29 +1,31 @@
+# type is the type of the values of a unit (number, date or bool), values of
+# units without type are stored as text only
 units = [
-    dict(name='ns',     label='Nanosecond', format='%(unit)s ns'),
-    dict(name='nm',     label='Nanometer', format='%(unit)s nm'),
-    dict(name='mm',     label='Millimeter', format='%(unit)s mm'),
-    dict(name='mm^2',   label='Square millimeter', format='%(unit)s mm<sup>2</sup>'),
-    dict(name='MHz',    label='Megahertz', format='%(unit)s MHz', note='We dont use the minimal unit Hertz because processors are in the MHz area'),
-    dict(name='date',   label='Date'),
-    dict(name='year',   label='Year'),
-    dict(name='count',  label='Count'),
-    dict(name='order',  label='Order', note='Information about the order/sequence of a Part'),
-    dict(name='B',      label='Byte', format='%(unit)s Byte'),
-    dict(name='KB',     label='Kilobyte', format='%(unit)s KB'),
-    dict(name='MB',     label='Megabyte', format='%(unit)s MMB'),
-    dict(name='MiB',    label='Mebibyte', format='%(unit)s MiB'),
-    dict(name='GB',     label='Gigabyte', format='%(unit)s GB'),
-    dict(name='MT/s',   label='Megatransfer/Second', format='%(unit)s MT/s'),
-    dict(name='MB/s',   label='Megabyte/Second', format='%(unit)s MB/s'),
-    dict(name='factor', label='Factor', format='%(unit)sx', note='ie cpu clock multiplier'),
-    dict(name='V',      label='Volt', format='%(unit)s V'),
-    dict(name='W',      label='Watt', format='%(unit)s W'),
-    dict(name='$',      label='Dollar', format='$%(unit)s'),
+    dict(name='ns',     label='Nanosecond', format='%(unit)s ns', type='number'),
+    dict(name='nm',     label='Nanometer', format='%(unit)s nm', type='number'),
+    dict(name='mm',     label='Millimeter', format='%(unit)s mm', type='number'),
+    dict(name='mm^2',   label='Square millimeter', format='%(unit)s mm<sup>2</sup>', type='number'),
+    dict(name='MHz',    label='Megahertz', format='%(unit)s MHz', note='We dont use the minimal unit Hertz because processors are in the MHz area', type='number'),
+    dict(name='date',   label='Date', type='date'),
+    dict(name='year',   label='Year', type='number'),
+    dict(name='count',  label='Count', type='number'),
+    dict(name='order',  label='Order', note='Information about the order/sequence of a Part', type='number'),
+    dict(name='B',      label='Byte', format='%(unit)s Byte', type='number'),
+    dict(name='KB',     label='Kilobyte', format='%(unit)s KB', type='number'),
+    dict(name='MB',     label='Megabyte', format='%(unit)s MMB', type='number'),
+    dict(name='MiB',    label='Mebibyte', format='%(unit)s MiB', type='number'),
+    dict(name='GB',     label='Gigabyte', format='%(unit)s GB', type='number'),
+    dict(name='MT/s',   label='Megatransfer/Second', format='%(unit)s MT/s', type='number'),
+    dict(name='MB/s',   label='Megabyte/Second', format='%(unit)s MB/s', type='number'),
+    dict(name='factor', label='Factor', format='%(unit)sx', note='ie cpu clock multiplier', type='number'),
+    dict(name='V',      label='Volt', format='%(unit)s V', type='number'),
+    dict(name='W',      label='Watt', format='%(unit)s W', type='number'),
+    dict(name='$',      label='Dollar', format='$%(unit)s', type='number'),
     dict(name='url',    label='Url', format='<a href="%(unit)s">%(unit)s</a>'),
     dict(name='text',   label='Text'),
-    dict(name='bool',   label='Boolean'),
+    dict(name='bool',   label='Boolean', type='bool'),
     dict(name='hex',    label='Hex'),
-    dict(name='clock_cycles', label='Number of clock cycles', note='Should this be merged with "Count"? Used for RAM timings'),
+    dict(name='clock_cycles', label='Number of clock cycles', note='Should this be merged with "Count"? Used for RAM timings', type='number'),
     dict(name='json', label='JSON encoded string'),
 ]
 
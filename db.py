@@ -1,38 +1,207 @@
 import os
+import datetime
 
-from readcsv import read_all_files
-from model import R, g, get_node_classes
+from readcsv import read_all_files, SectionCache
+from model import R, g, get_node_classes, BulkLoader
 import treetools
 import data
 
 
+DATE_FORMATS = ('%Y-%m-%d', '%B %d, %Y', '%b %d, %Y', '%B %Y', '%b %Y', '%Y')
+BOOL_VALUES = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
 
-def _load_units():
+
+def _parse_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(unicode(value).strip(), date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    return None
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return BOOL_VALUES.get(unicode(value).strip().lower())
+
+
+# Unit.value_type -> (name of the Attribute property, parse function)
+VALUE_TYPES = {
+    'number': ('number', _parse_number),
+    'date': ('date', _parse_date),
+    'bool': ('flag', _parse_bool),
+}
+
+
+def _count_invalid_value(invalid_values, attr_type, value_type, typed_values):
+    """ Count the value in invalid_values if it could not be parsed """
+    if value_type is not None and not any(v is not None for v in typed_values.itervalues()):
+        key = (attr_type, value_type)
+        invalid_values[key] = invalid_values.get(key, 0) + 1
+
+
+def _print_invalid_values(invalid_values):
+    # One line per attr type instead of one per value, ranges like
+    # "1.1-1.5 V" or timings like "2-2-2" are common in the csv files
+    for (attr_type, value_type), count in sorted(invalid_values.iteritems()):
+        print 'Warning: %s values of %s are no valid %s, they are kept as text' % (count, attr_type, value_type)
+
+
+def get_typed_values(value_type, value):
+    """ Returns the typed properties of an Attribute with the given value,
+    all are None if value_type is None or value could not be parsed """
+    d = dict((name, None) for name, parse in VALUE_TYPES.itervalues())
+    if value_type is not None:
+        name, parse = VALUE_TYPES[value_type]
+        d[name] = parse(value)
+    return d
+
+
+
+class ImportSession(object):
+    """ Routes all writes and lookups of an import.
+
+    All labeled nodes present in the graph are loaded once when the session
+    is created, lookups by label are answered from memory. In bulk mode
+    nothing is written until flush() is called. With preload=False the graph
+    is not read at all, the session starts as if the graph was empty """
+
+    def __init__(self, bulk=False, chunk_size=1000, preload=True):
+        self._loader = BulkLoader(g, chunk_size) if bulk else None
+        # (element_type, label) -> node
+        self._labels = {}
+        # (value, attr_type label) -> attribute or eid of an attribute which
+        # is not loaded yet. Attr type labels are unique and known in bulk
+        # mode before eids are assigned.
+        self._attributes = {}
+        # attr_type label -> value_type of its unit
+        self._value_types = {}
+        # (attr_type label, value_type) -> number of values which are no
+        # valid value_type, they are only stored as strings
+        self.invalid_values = {}
+        if preload:
+            self._preload()
+
+
+    def _preload(self):
+        for name, cls in g.classes.iteritems():
+            if 'label' in cls.properties:
+                for node in getattr(g, name).get_all():
+                    self._labels[(name, node.P.label)] = node
+        for eid, value, attr_type_label in g.get_attribute_keys():
+            self._attributes[(value, attr_type_label)] = eid
+        for unit in g.Unit.get_all():
+            for attr_type in unit.get_attr_types():
+                self._value_types[attr_type.P.label] = unit.P.value_type
+
+
+    def create(self, proxy, **kwargs):
+        label = kwargs.get('label')
+        key = (proxy._cls.__name__, label)
+        if label is not None and key in self._labels:
+            raise Exception('Duplicate entry %s' % label)
+
+        if self._loader:
+            node = self._loader.create(proxy, **kwargs)
+        else:
+            node = proxy.create(**kwargs)
+
+        if label is not None:
+            self._labels[key] = node
+        return node
+
+
+    def relate(self, rel_cls, outV, inV, **kwargs):
+        if rel_cls is R.IsUnit:
+            self._value_types[outV.P.label] = inV.P.value_type
+
+        if self._loader:
+            self._loader.relate(rel_cls, outV, inV, **kwargs)
+        else:
+            rel_cls.create(outV, inV, **kwargs)
+
+
+    def get_all(self, proxy, label):
+        node = self._labels.get((proxy._cls.__name__, label))
+        return [node] if node is not None else []
+
+
+    def get_one(self, proxy, label):
+        result = self.get_all(proxy, label)
+        if len(result) != 1:
+            raise Exception('Found %s %s with label %r' % (len(result), proxy._cls.__name__, label))
+        return result[0]
+
+
+    def get_attribute(self, value, attr_type):
+        """ Returns the attribute with the given value and attr_type, creates
+        it if necessary """
+        # Values are stored as strings
+        key = (unicode(value), attr_type.P.label)
+        attribute = self._attributes.get(key)
+
+        if isinstance(attribute, (int, long)):
+            attribute = g.get_from_eid(attribute)
+        elif attribute is None:
+            value_type = self._value_types.get(attr_type.P.label)
+            typed_values = get_typed_values(value_type, value)
+            _count_invalid_value(self.invalid_values, attr_type.P.label, value_type, typed_values)
+            attribute = self.create(g.Attribute, value=value, **typed_values)
+            self.relate(R.HasAttrType, attribute, attr_type)
+
+        self._attributes[key] = attribute
+        return attribute
+
+
+    def flush(self):
+        if self._loader:
+            self._loader.flush()
+
+
+    def get_pending(self):
+        """ Returns the nodes and relationships collected in bulk mode """
+        return self._loader.get_pending()
+
+
+
+def _load_units(session):
     for unit in data.units:
+        # data.units is read again by migrate_typed_values()
+        unit = unit.copy()
         d = {
             'name': unit.pop('label'),
             'label': unit.pop('name'),
             'format': unit.pop('format', '%(unit)s'),
             'note': unit.pop('note', None),
+            'value_type': unit.pop('type', None),
         }
         assert not unit
-        g.Unit.create(**d)
+        session.create(g.Unit, **d)
 
 
-def _load_attr_types():
+def _load_attr_types(session):
     for attr_type in data.attr_types:
-        unit = g.Unit.get_one(label=attr_type.pop('unit'))
+        attr_type = attr_type.copy()
+        unit = session.get_one(g.Unit, attr_type.pop('unit'))
         attr_type['label'] = attr_type.pop('name')
-        attr_type_obj = g.AttrType.create(**attr_type)
-        R.IsUnit.create(attr_type_obj, unit)
+        attr_type_obj = session.create(g.AttrType, **attr_type)
+        session.relate(R.IsUnit, attr_type_obj, unit)
 
 
-def _add_element(el_dict, parent_el, element_type, root_element_node, extra_properties={}):
+def _add_element(session, el_dict, parent_el, element_type, root_element_node, extra_properties={}):
     assert 'attr_types' not in el_dict, 'attr_types should be on the first level elements of the part tree (or should they?)'
     label = el_dict.pop('<name>')
 
     # Check if element is already present
-    result = element_type.get_all(label=label)
+    result = session.get_all(element_type, label)
     if result:
         (el,) = result
         if not 'is_schema' in el.properties or not el.P.is_schema:
@@ -44,114 +213,97 @@ def _add_element(el_dict, parent_el, element_type, root_element_node, extra_prop
             'note': el_dict.pop('<note>', None),
         }
         d.update(extra_properties)
-        el = element_type.create(**d)
+        el = session.create(element_type, **d)
 
         if parent_el is None:
-            R.IsA.create(el, root_element_node)
+            session.relate(R.IsA, el, root_element_node)
         else:
-            R.IsA.create(el, parent_el)
+            session.relate(R.IsA, el, parent_el)
 
         for attr_type_name in el_dict.pop('<attr_types>', []):
-            attr_type = g.AttrType.get_one(label=attr_type_name)
-            R.CanHaveAttrType.create(el, attr_type)
+            attr_type = session.get_one(g.AttrType, attr_type_name)
+            session.relate(R.CanHaveAttrType, el, attr_type)
 
         for attr_type_name, attr_value in el_dict.pop('<attrs>', {}).iteritems():
-            res = g.AttrType.get_all(label=attr_type_name)
+            res = session.get_all(g.AttrType, attr_type_name)
             if not res:
                 raise Exception('Could not find attr_type %s' % attr_type_name)
             (attr_type,) = res
 
-            # Try to find an exisiting attribute with the same value and attr_type
-            attribute = None
-            for attribute_2 in g.Attribute.get_all(value=attr_value) or []:
-                (attr_type_2,) = attribute_2._bulbs_node.outV('HasAttrType')
-                if attr_type._bulbs_node == attr_type_2:
-                    attribute = attribute_2
-                    break
-
-            if not attribute:
-                attribute = g.Attribute.create(value=attr_value)
-                R.HasAttrType.create(attribute, attr_type)
-
-            R.HasAttribute.create(el, attribute)
+            attribute = session.get_attribute(attr_value, attr_type)
+            session.relate(R.HasAttribute, el, attribute)
 
         for standard_name in el_dict.pop('<standards>', []):
-            standard = g.Standard.get_one(label=standard_name)
-            R.Implements.create(el, standard)
+            standard = session.get_one(g.Standard, standard_name)
+            session.relate(R.Implements, el, standard)
 
         for conn_dict in el_dict.pop('<connectors>', []):
             conn_label = conn_dict.pop('<name>')
-            result = g.Connector.get_all(label=conn_label)
+            result = session.get_all(g.Connector, conn_label)
             if not result:
-                raise Exception('Could not find connector %r to connecto %r' % (conn_label, el.label))
+                raise Exception('Could not find connector %r to connecto %r' % (conn_label, label))
             (connector,) = result
-            R.HasConnector.create(el, connector, quantity=conn_dict.pop('<quantity>', 1))
+            session.relate(R.HasConnector, el, connector, quantity=conn_dict.pop('<quantity>', 1))
 
     for child_el_dict in el_dict.pop('<children>', []):
-        _add_element(child_el_dict, el, element_type, root_element_node, extra_properties)
+        _add_element(session, child_el_dict, el, element_type, root_element_node, extra_properties)
 
     assert not el_dict, el_dict
 
 
-def _load_part_schema(root_part, csv_files):
-    parts = treetools.inflate_tree(data.part_schema, csv_files, 'parts')
+def _load_part_schema(session, root_part, parts):
     for part_dict in parts:
-        _add_element(part_dict, None, g.Part, root_part, extra_properties={'is_schema': True})
+        _add_element(session, part_dict, None, g.Part, root_part, extra_properties={'is_schema': True})
 
 
-def _load_standards(root_standard, csv_files):
-    standards = treetools.inflate_tree(data.standards, csv_files, 'standards')
+def _load_standards(session, root_standard, standards):
     for standard_dict in standards:
-        _add_element(standard_dict, None, g.Standard, root_standard)
+        _add_element(session, standard_dict, None, g.Standard, root_standard)
 
 
-def _load_connectors(root_connector, csv_files):
-    connectors = treetools.inflate_tree(data.connectors, csv_files, 'connectors')
+def _load_connectors(session, root_connector, connectors):
     for connector_dict in connectors:
-        _add_element(connector_dict, None, g.Connector, root_connector)
+        _add_element(session, connector_dict, None, g.Connector, root_connector)
 
 
-def _load_operating_systems(root_os, csv_files):
-    osses = treetools.inflate_tree(data.os, csv_files, 'operating_systems')
+def _load_operating_systems(session, root_os, osses):
     for os_dict in osses:
-        _add_element(os_dict, None, g.OperatingSystem, root_os)
+        _add_element(session, os_dict, None, g.OperatingSystem, root_os)
 
 
-def _load_parts(csv_files):
-    parts = treetools.inflate_tree(data.parts, csv_files, 'parts')
+def _load_parts(session, parts):
     for part_dict in parts:
-        part = g.Part.get_one(label=part_dict.pop('<name>'))
+        part = session.get_one(g.Part, part_dict.pop('<name>'))
         for child_part_dict in part_dict.pop('<children>'):
-            _add_element(child_part_dict, part, g.Part, None)
+            _add_element(session, child_part_dict, part, g.Part, None)
 
         assert not part_dict, part_dict
 
 
-def _load_connection_schema(connection_schema_root):
+def _load_connection_schema(session, connection_schema_root, connections):
     def _add_connection_schema(parent_part, child_part_dicts):
         for child_part_dict in child_part_dicts:
-            child_part = g.Part.get_one(label=child_part_dict.pop('<name>'))
-            R.CanBeContainedIn.create(child_part, parent_part)
+            child_part = session.get_one(g.Part, child_part_dict.pop('<name>'))
+            session.relate(R.CanBeContainedIn, child_part, parent_part)
             _add_connection_schema(child_part, child_part_dict.pop('<children>', []))
 
-    connections = treetools.inflate_tree(data.connection_schema)
     for root_part_dict in connections:
-        root_part = g.Part.get_one(label=root_part_dict.pop('<name>'))
-        R.IsAConnectionSchemaRoot.create(root_part, connection_schema_root)
+        root_part = session.get_one(g.Part, root_part_dict.pop('<name>'))
+        session.relate(R.IsAConnectionSchemaRoot, root_part, connection_schema_root)
         _add_connection_schema(root_part, root_part_dict.pop('<children>'))
 
         assert not root_part_dict
 
 
-def _load_connections(connection_root, systems):
+def _load_connections(session, connection_root, systems):
     def _create_connection(system_part, parent_part, child_dict, connector):
-        child_part = g.Part.get_one(label=child_dict.pop('<name>'))
-        connection = g.Connection.create(quantity=child_dict.pop('<quantity>', 1))
-        R.BelongsTo.create(connection, system_part)
-        R.ConnectedFrom.create(parent_part, connection)
-        R.ConnectedTo.create(connection, child_part)
+        child_part = session.get_one(g.Part, child_dict.pop('<name>'))
+        connection = session.create(g.Connection, quantity=child_dict.pop('<quantity>', 1))
+        session.relate(R.BelongsTo, connection, system_part)
+        session.relate(R.ConnectedFrom, parent_part, connection)
+        session.relate(R.ConnectedTo, connection, child_part)
         if connector:
-            R.ConnectedVia.create(connection, connector)
+            session.relate(R.ConnectedVia, connection, connector)
 
         _add_connection(system_part, child_part, child_dict)
         assert not child_dict, child_dict
@@ -162,7 +314,7 @@ def _load_connections(connection_root, systems):
             _create_connection(system_part, parent_part, child_dict, None)
 
         for conn_dict in part_dict.pop('<connectors>', []):
-            connector = g.Connector.get_one(label=conn_dict.pop('<name>'))
+            connector = session.get_one(g.Connector, conn_dict.pop('<name>'))
             for child_dict in conn_dict.pop('<children>', []):
                 _create_connection(system_part, parent_part, child_dict, connector)
 
@@ -170,62 +322,238 @@ def _load_connections(connection_root, systems):
 
 
     for system_dict in systems:
-        system_part = g.Part.get_one(label=system_dict.pop('<name>'))
-        R.HasConnection.create(system_part, connection_root)
+        system_part = session.get_one(g.Part, system_dict.pop('<name>'))
+        session.relate(R.HasConnection, system_part, connection_root)
         _add_connection(system_part, system_part, system_dict)
         assert not system_dict, system_dict
 
 
-def check_data():
-    # check if the data structure is correct
-    for name in 'part_schema connection_schema standards connectors parts systems'.split():
-        treetools.inflate_tree(getattr(data, name))
-
-    # check if the names are unique
-    for name in 'part_schema connection_schema standards connectors parts'.split():
-        treetools.inflate_tree(getattr(data, name), check_unique_names=True)
-
+# name of the tree in data.py, label of its elements in the csv files and
+# whether its names have to be unique
+DATA_TREES = (
+    ('part_schema', 'parts', True),
+    ('connection_schema', None, True),
+    ('standards', 'standards', True),
+    ('connectors', 'connectors', True),
+    ('parts', 'parts', True),
+    ('systems', None, False),
+    ('os', 'operating_systems', False),
+)
+
+
+def check_data(csv_files={}):
+    """ Inflates the trees of data.py, the elements of csv_files are added
+    where they are imported. Raises an exception if the structure of a tree
+    is not correct or if it contains a name twice. Returns a dict with the
+    inflated trees by name, they are used for the import """
+    trees = {}
+    for name, csv_label, check_unique_names in DATA_TREES:
+        trees[name] = treetools.inflate_tree(getattr(data, name), csv_files, csv_label, check_unique_names)
+    return trees
+
+
+def migrate_typed_values():
+    """ Set the value types of the units from data.units and the typed
+    properties of all attributes, for databases imported before they
+    existed """
+    value_types = dict((unit['name'], unit.get('type')) for unit in data.units)
+    invalid_values = {}
+    for unit in g.Unit.get_all():
+        unit.update(value_type=value_types.get(unit.P.label))
+        unit.save()
+        for attr_type in unit.get_attr_types():
+            print 'Migrate %s' % attr_type.P.label
+            for attribute in attr_type.inV('HasAttrType'):
+                typed_values = get_typed_values(unit.P.value_type, attribute.P.value)
+                _count_invalid_value(invalid_values, attr_type.P.label, unit.P.value_type, typed_values)
+                attribute.update(typed_values)
+                attribute.save()
+    _print_invalid_values(invalid_values)
+
+
+def _read_csv_files(csv_path, jobs, cache, force_sections):
+    if os.path.isfile(csv_path):
+        return read_all_files(csv_path, jobs, cache, force_sections)
+    print '%s is no path, skipping reading of csv file' % csv_path
+    return {}
 
-def reset_db(csv_path):
-    check_data()
 
-    root_part = g.RootPart.create()
-    root_standard = g.RootStandard.create()
-    root_connector = g.RootConnector.create()
-    connection_root = g.ConnectionRoot.create()
-    connection_schema_root = g.ConnectionSchemaRoot.create()
-    operating_system_root = g.RootOperatingSystem.create()
-
-    if os.path.isfile(csv_path):
-        csv_files = read_all_files(csv_path)
-    else:
-        print '%s is no path, skipping reading of csv file' % csv_path
-        csv_files = {}
+def _load_all(session, trees, csv_files):
+    root_part = session.create(g.RootPart)
+    root_standard = session.create(g.RootStandard)
+    root_connector = session.create(g.RootConnector)
+    connection_root = session.create(g.ConnectionRoot)
+    connection_schema_root = session.create(g.ConnectionSchemaRoot)
+    operating_system_root = session.create(g.RootOperatingSystem)
 
     print '== Import units =='
-    _load_units()
+    _load_units(session)
     print '== Import attr types =='
-    _load_attr_types()
+    _load_attr_types(session)
     print '== Import operating systems =='
-    _load_operating_systems(operating_system_root, csv_files)
+    _load_operating_systems(session, operating_system_root, trees['os'])
     print '== Import part schema =='
-    _load_part_schema(root_part, csv_files)
+    _load_part_schema(session, root_part, trees['part_schema'])
     print '== Import connection schema =='
-    _load_connection_schema(connection_schema_root)
+    _load_connection_schema(session, connection_schema_root, trees['connection_schema'])
     print '== Import standards =='
-    _load_standards(root_standard, csv_files)
+    _load_standards(session, root_standard, trees['standards'])
     print '== Import connectors =='
-    _load_connectors(root_connector, csv_files)
+    _load_connectors(session, root_connector, trees['connectors'])
     print '== Import parts =='
-    _load_parts(csv_files)
+    _load_parts(session, trees['parts'])
     print '== Import systems from data.py =='
-    systems = treetools.inflate_tree(data.systems, 'connections')
-    _load_connections(connection_root, systems)
+    _load_connections(session, connection_root, trees['systems'])
 
     if 'Pentium4_Willamette' in csv_files:
         print '== Import systems from csv=='
-        _load_connections(connection_root, csv_files['Pentium4_Willamette']['connections'])
+        _load_connections(session, connection_root, csv_files['Pentium4_Willamette']['connections'])
     else:
         print 'Warning: csv file part Pentium4_Willamette was not found, skipping import'
 
+    _print_invalid_values(session.invalid_values)
+
+
+def reset_db(csv_path, bulk=False, chunk_size=1000, jobs=1, cache_path=None, force_sections=()):
+    """ Import data.py and the csv files into an empty graph. With cache_path
+    csv files which did not change since the last import are not parsed
+    again, see readcsv.SectionCache """
+    cache = SectionCache(cache_path) if cache_path else None
+    csv_files = _read_csv_files(csv_path, jobs, cache, force_sections)
+    trees = check_data(csv_files)
+
+    session = ImportSession(bulk, chunk_size)
+    _load_all(session, trees, csv_files)
+
+    if bulk:
+        nodes, edges = session.get_pending()
+        print '== Write %s nodes and %s relationships to database ==' % (len(nodes), len(edges))
+    session.flush()
+    if cache:
+        cache.save()
+
     print 'Finished importing'
+
+
+def _freeze(d):
+    """ Hashable form of a property dict, None values count as missing """
+    return frozenset((k, v) for k, v in d.iteritems() if v is not None and k != 'element_type')
+
+
+def _get_node_keys(nodes, edges):
+    """ Returns a key for each of nodes which identifies it independent of
+    its eid. nodes is a list of (element_type, properties), edges a list of
+    (label, out index, in index, data).
+
+    Labeled nodes are identified by element_type and label. All other nodes
+    by element_type, properties and the edges they point to, e.g. an
+    attribute by its value and the label of its attr type """
+    out_edges = {}
+    for label, out_index, in_index, edge_data in edges:
+        out_edges.setdefault(out_index, []).append((label, in_index, edge_data))
+
+    keys = [None] * len(nodes)
+    def get_key(i):
+        if keys[i] is None:
+            element_type, properties = nodes[i]
+            if 'label' in g.classes[element_type].properties:
+                keys[i] = (element_type, properties.get('label'))
+            else:
+                targets = sorted((label, get_key(in_index), _freeze(edge_data))
+                                 for label, in_index, edge_data in out_edges.get(i, []))
+                keys[i] = (element_type, _freeze(properties), tuple(targets))
+        return keys[i]
+    return [get_key(i) for i in xrange(len(nodes))]
+
+
+def _match_nodes(wanted_keys, live_keys):
+    """ Returns the index of the live node with the same key for each wanted
+    node (None if there is none) and the indexes of the live nodes left
+    over. Nodes with equal keys are paired in order """
+    live_by_key = {}
+    for i, key in enumerate(live_keys):
+        live_by_key.setdefault(key, []).append(i)
+
+    matches = []
+    for key in wanted_keys:
+        l = live_by_key.get(key)
+        matches.append(l.pop(0) if l else None)
+    left_over = sorted(i for l in live_by_key.itervalues() for i in l)
+    return matches, left_over
+
+
+def sync_db(csv_path, chunk_size=1000, jobs=1, cache_path=None, force_sections=()):
+    """ Import data.py and the csv files like reset_db(), but instead of
+    clearing the graph only the difference to the graph is written: missing
+    nodes and relationships are created, changed properties updated and
+    nodes and relationships which are not wanted anymore deleted. Unchanged
+    csv files therefore cause no writes """
+    cache = SectionCache(cache_path) if cache_path else None
+    csv_files = _read_csv_files(csv_path, jobs, cache, force_sections)
+    trees = check_data(csv_files)
+
+    # Collect the wanted graph in memory, without reading the database
+    session = ImportSession(bulk=True, chunk_size=chunk_size, preload=False)
+    _load_all(session, trees, csv_files)
+    nodes, edges = session.get_pending()
+    indexes = dict((id(node), i) for i, node in enumerate(nodes))
+    wanted_nodes = [(node.element_type, node.P) for node in nodes]
+    wanted_edges = [(label, indexes[id(outV)], indexes[id(inV)], edge_data)
+                    for label, outV, inV, edge_data in edges]
+
+    print '== Compare with database =='
+    vertex_rows, edge_rows = g.get_graph_rows()
+    # Vertices of other applications (e.g. the neo4j reference node) are ignored
+    vertex_rows = [(eid, properties) for eid, properties in sorted(vertex_rows)
+                   if properties.get('element_type') in g.classes]
+    live_indexes = dict((eid, i) for i, (eid, properties) in enumerate(vertex_rows))
+    edge_rows = [row for row in edge_rows if row[2] in live_indexes and row[3] in live_indexes]
+    live_nodes = [(properties['element_type'], properties) for eid, properties in vertex_rows]
+    live_edges = [(label, live_indexes[out_eid], live_indexes[in_eid], edge_data)
+                  for eid, label, out_eid, in_eid, edge_data in edge_rows]
+
+    matches, left_over = _match_nodes(_get_node_keys(wanted_nodes, wanted_edges),
+                                      _get_node_keys(live_nodes, live_edges))
+
+    updated = []
+    for node, live_index in zip(nodes, matches):
+        if live_index is not None:
+            eid, properties = vertex_rows[live_index]
+            node.eid = eid
+            if _freeze(node.P) != _freeze(properties):
+                updated.append(node)
+    created = [node for node in nodes if node.eid is None]
+    deleted = set(vertex_rows[i][0] for i in left_over)
+
+    # (label, out eid, in eid, data) -> eids of the live edges
+    live_edge_eids = {}
+    for eid, label, out_eid, in_eid, edge_data in edge_rows:
+        if out_eid not in deleted and in_eid not in deleted:
+            live_edge_eids.setdefault((label, out_eid, in_eid, _freeze(edge_data)), []).append(eid)
+    created_edges = []
+    for edge in edges:
+        label, outV, inV, edge_data = edge
+        l = live_edge_eids.get((label, outV.eid, inV.eid, _freeze(edge_data)))
+        if l:
+            l.pop()
+        else:
+            created_edges.append(edge)
+    deleted_edges = [eid for l in live_edge_eids.itervalues() for eid in l]
+
+    print 'Create %s nodes, update %s nodes, delete %s nodes' % (len(created), len(updated), len(deleted))
+    print 'Create %s relationships, delete %s relationships' % (len(created_edges), len(deleted_edges))
+    for eid in deleted:
+        g.backend.delete_vertex(eid)
+    for eid in deleted_edges:
+        g.backend.delete_edge(eid)
+    for node in updated:
+        vertex = g.get_from_eid(node.eid)
+        vertex.update(dict((name, node.P.get(name)) for name in node.properties))
+        vertex.save()
+    g.backend.write_bulk(created, created_edges, chunk_size)
+    g.cache.clear()
+    g.ancestors.clear()
+    if cache:
+        cache.save()
+
+    print 'Finished syncing'
@@ -0,0 +1,520 @@
+""" Embedded graph store on top of sqlite, used as storage backend of
+model.Graph (see model.BulbsBackend for the interface). It needs neither a
+neo4j server nor a JVM, so it is also used for the tests. """
+
+import json
+import sqlite3
+import threading
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS vertex (
+    eid INTEGER PRIMARY KEY,
+    element_type TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vertex_element_type ON vertex (element_type);
+
+CREATE TABLE IF NOT EXISTS vertex_property (
+    eid INTEGER NOT NULL,
+    element_type TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS vertex_property_lookup ON vertex_property (element_type, key, value);
+CREATE INDEX IF NOT EXISTS vertex_property_eid ON vertex_property (eid);
+
+CREATE TABLE IF NOT EXISTS edge (
+    eid INTEGER PRIMARY KEY,
+    label TEXT NOT NULL,
+    out_eid INTEGER NOT NULL,
+    in_eid INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS edge_out ON edge (out_eid, label);
+CREATE INDEX IF NOT EXISTS edge_in ON edge (in_eid, label);
+CREATE INDEX IF NOT EXISTS edge_label ON edge (label);
+
+-- Closure table of the CLOSURE_LABEL edges: a row for every vertex and each
+-- of its ancestors, depth is the number of edges between them
+CREATE TABLE IF NOT EXISTS closure (
+    ancestor_eid INTEGER NOT NULL,
+    descendant_eid INTEGER NOT NULL,
+    depth INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS closure_ancestor ON closure (ancestor_eid, depth);
+CREATE INDEX IF NOT EXISTS closure_descendant ON closure (descendant_eid);
+'''
+
+# Edges of this label form trees, their closure is kept in the closure table
+CLOSURE_LABEL = 'IsA'
+
+
+
+def _placeholders(l):
+    return ', '.join('?' * len(l))
+
+
+
+class LocalVertex(object):
+    """ Properties are accessible as attributes, like with bulbs vertices """
+
+    def __init__(self, backend, eid, data):
+        object.__setattr__(self, '_backend', backend)
+        object.__setattr__(self, '_eid', eid)
+        object.__setattr__(self, '_data', data)
+
+    @property
+    def eid(self):
+        return self._eid
+
+    def __getattr__(self, name):
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._data[name] = value
+
+    def __eq__(self, other):
+        return isinstance(other, LocalVertex) and self._eid == other._eid
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._eid)
+
+    def __repr__(self):
+        return '<LocalVertex %s %r>' % (self._eid, self._data)
+
+    def save(self):
+        self._backend.save_vertex(self)
+
+    def inV(self, label=None):
+        return self._backend.get_adjacent(self._eid, 'in', label)
+
+    def outV(self, label=None):
+        return self._backend.get_adjacent(self._eid, 'out', label)
+
+
+
+class LocalEdge(object):
+    def __init__(self, eid, label, out_eid, in_eid, data):
+        self.eid = eid
+        self.label = label
+        self.out_eid = out_eid
+        self.in_eid = in_eid
+        self._data = data
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_data'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+
+class _LocalIndex(object):
+    def __init__(self, backend, element_type):
+        self._backend = backend
+        self.index_name = element_type
+
+    def lookup(self, key, value):
+        return self._backend.lookup(self.index_name, key, value)
+
+
+
+class _LocalNodeProxy(object):
+    def __init__(self, backend, element_type, properties):
+        self._backend = backend
+        self.element_type = element_type
+        self.properties = properties
+        self.index = _LocalIndex(backend, element_type)
+
+    def _get_data(self, values):
+        data = {}
+        for name, prop in self.properties.iteritems():
+            value = values.get(name)
+            if value is not None:
+                value = prop.coerce(name, value)
+            prop.validate(name, value)
+            if value is not None:
+                data[name] = value
+        data['element_type'] = self.element_type
+        return data
+
+    def create(self, **kwargs):
+        for name, prop in self.properties.iteritems():
+            if kwargs.get(name) is None:
+                kwargs[name] = prop.default
+        return self._backend.create_vertex(self.element_type, self._get_data(kwargs))
+
+    def get_all(self):
+        return self._backend.get_vertices(self.element_type)
+
+
+
+class _LocalRelationshipProxy(object):
+    def __init__(self, backend, label):
+        self._backend = backend
+        self.label = label
+
+    def create(self, outV, inV, _data=None, **kwargs):
+        # Vertices or eids, as with bulbs
+        data = dict(_data or {}, **kwargs)
+        return self._backend.create_edge(self.label, getattr(outV, 'eid', outV), getattr(inV, 'eid', inV), data)
+
+
+
+class LocalBackend(object):
+    """ Storage backend keeping the graph in a sqlite database. Property
+    lookups use an index on (element_type, key, value), traversals use
+    indexes on the edge labels. """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._proxies = {}
+        # Databases created before the closure table existed
+        if (self._query('SELECT 1 FROM edge WHERE label=? LIMIT 1', (CLOSURE_LABEL, )) and
+                not self._query('SELECT 1 FROM closure LIMIT 1')):
+            self._rebuild_closure()
+
+
+    def _query(self, query, params=()):
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+
+    def add_node_class(self, name, cls):
+        proxy = _LocalNodeProxy(self, name, cls.properties)
+        self._proxies[name] = proxy
+        return proxy
+
+
+    def add_relationship_class(self, name, rel_cls):
+        return _LocalRelationshipProxy(self, name)
+
+
+    def _insert_vertex(self, element_type, data):
+        cursor = self._conn.execute('INSERT INTO vertex (element_type, data) VALUES (?, ?)',
+                                    (element_type, json.dumps(data)))
+        eid = cursor.lastrowid
+        self._conn.executemany('INSERT INTO vertex_property (eid, element_type, key, value) VALUES (?, ?, ?, ?)',
+                               [(eid, element_type, key, value) for key, value in data.iteritems()])
+        return eid
+
+
+    def _insert_edge(self, label, out_eid, in_eid, data):
+        cursor = self._conn.execute('INSERT INTO edge (label, out_eid, in_eid, data) VALUES (?, ?, ?, ?)',
+                                    (label, out_eid, in_eid, json.dumps(data)))
+        if label == CLOSURE_LABEL:
+            self._add_to_closure(out_eid, in_eid)
+        return cursor.lastrowid
+
+
+    def _add_to_closure(self, child_eid, parent_eid):
+        # Connect the parent and its ancestors with the child and its
+        # descendants
+        self._conn.execute(
+            'INSERT INTO closure (ancestor_eid, descendant_eid, depth) '
+            'SELECT ancestor.eid, descendant.eid, ancestor.depth + descendant.depth + 1 FROM '
+            '    (SELECT ancestor_eid AS eid, depth FROM closure WHERE descendant_eid=? UNION ALL SELECT ?, 0) ancestor, '
+            '    (SELECT descendant_eid AS eid, depth FROM closure WHERE ancestor_eid=? UNION ALL SELECT ?, 0) descendant',
+            (parent_eid, parent_eid, child_eid, child_eid))
+
+
+    def _remove_from_closure(self, child_eid, parent_eid):
+        # In a tree all paths between these vertices use the edge
+        self._conn.execute(
+            'DELETE FROM closure '
+            'WHERE ancestor_eid IN (SELECT ancestor_eid FROM closure WHERE descendant_eid=? UNION SELECT ?) '
+            '  AND descendant_eid IN (SELECT descendant_eid FROM closure WHERE ancestor_eid=? UNION SELECT ?)',
+            (parent_eid, parent_eid, child_eid, child_eid))
+
+
+    def _rebuild_closure(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM closure')
+            self._conn.execute(
+                'WITH RECURSIVE path(ancestor_eid, descendant_eid, depth) AS ('
+                '    SELECT in_eid, out_eid, 1 FROM edge WHERE label=?'
+                '    UNION ALL'
+                '    SELECT path.ancestor_eid, edge.out_eid, path.depth + 1 FROM path '
+                '    JOIN edge ON edge.in_eid = path.descendant_eid AND edge.label=?'
+                ') '
+                'INSERT INTO closure (ancestor_eid, descendant_eid, depth) SELECT * FROM path',
+                (CLOSURE_LABEL, CLOSURE_LABEL))
+
+
+    def create_vertex(self, element_type, data):
+        with self._lock, self._conn:
+            eid = self._insert_vertex(element_type, data)
+        return LocalVertex(self, eid, data)
+
+
+    def update_vertex(self, element_type, eid, values):
+        data = self._proxies[element_type]._get_data(values)
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE vertex SET data=? WHERE eid=?', (json.dumps(data), eid))
+            self._conn.execute('DELETE FROM vertex_property WHERE eid=?', (eid, ))
+            self._conn.executemany('INSERT INTO vertex_property (eid, element_type, key, value) VALUES (?, ?, ?, ?)',
+                                   [(eid, element_type, key, value) for key, value in data.iteritems()])
+        return LocalVertex(self, eid, data)
+
+
+    def save_vertex(self, vertex):
+        saved = self.update_vertex(vertex.element_type, vertex.eid, vertex._data)
+        object.__setattr__(vertex, '_data', saved._data)
+
+
+    def create_edge(self, label, out_eid, in_eid, data):
+        with self._lock, self._conn:
+            eid = self._insert_edge(label, out_eid, in_eid, data)
+        return LocalEdge(eid, label, out_eid, in_eid, data)
+
+
+    def _make_vertices(self, rows):
+        return [LocalVertex(self, eid, json.loads(data)) for eid, data in rows]
+
+
+    def get_vertex(self, eid):
+        vertices = self._make_vertices(self._query('SELECT eid, data FROM vertex WHERE eid=?', (eid, )))
+        return vertices[0] if vertices else None
+
+
+    def get_vertices(self, element_type):
+        return self._make_vertices(self._query('SELECT eid, data FROM vertex WHERE element_type=?', (element_type, )))
+
+
+    def lookup(self, element_type, key, value):
+        return self._make_vertices(self._query(
+            'SELECT vertex.eid, vertex.data FROM vertex_property '
+            'JOIN vertex ON vertex.eid = vertex_property.eid '
+            'WHERE vertex_property.element_type=? AND key=? AND value=?', (element_type, key, value)))
+
+
+    def get_adjacent(self, eid, direction, label=None):
+        # inV() returns the vertices of the incoming edges, as in bulbs
+        near, far = ('in_eid', 'out_eid') if direction == 'in' else ('out_eid', 'in_eid')
+        query = 'SELECT vertex.eid, vertex.data FROM edge JOIN vertex ON vertex.eid = edge.%s WHERE edge.%s=?' % (far, near)
+        params = (eid, )
+        if label is not None:
+            query += ' AND label=?'
+            params += (label, )
+        return self._make_vertices(self._query(query, params))
+
+
+    def delete_vertex(self, eid):
+        with self._lock, self._conn:
+            for out_eid, in_eid in self._conn.execute('SELECT out_eid, in_eid FROM edge WHERE (out_eid=? OR in_eid=?) AND label=?',
+                                                      (eid, eid, CLOSURE_LABEL)).fetchall():
+                self._remove_from_closure(out_eid, in_eid)
+            self._conn.execute('DELETE FROM edge WHERE out_eid=? OR in_eid=?', (eid, eid))
+            self._conn.execute('DELETE FROM vertex_property WHERE eid=?', (eid, ))
+            self._conn.execute('DELETE FROM vertex WHERE eid=?', (eid, ))
+
+
+    def delete_edge(self, eid):
+        with self._lock, self._conn:
+            for out_eid, in_eid in self._conn.execute('SELECT out_eid, in_eid FROM edge WHERE eid=? AND label=?',
+                                                      (eid, CLOSURE_LABEL)).fetchall():
+                self._remove_from_closure(out_eid, in_eid)
+            self._conn.execute('DELETE FROM edge WHERE eid=?', (eid, ))
+
+
+    def clear(self):
+        with self._lock, self._conn:
+            for table in ('closure', 'edge', 'vertex_property', 'vertex'):
+                self._conn.execute('DELETE FROM %s' % table)
+
+
+    def _get_descendant_query(self, root_eid, labels):
+        """ Returns a WITH clause for the table descendant(eid) of the vertices
+        connected to root_eid by a chain of incoming edges with one of labels
+        and its params. CLOSURE_LABEL chains are read from the closure table,
+        other ones with a recursive query """
+        if labels == [CLOSURE_LABEL]:
+            return ('WITH descendant(eid) AS (SELECT descendant_eid FROM closure WHERE ancestor_eid=?) ', [root_eid])
+
+        return ('WITH RECURSIVE descendant(eid) AS ('
+                '    SELECT out_eid FROM edge WHERE in_eid=? AND label IN (%(labels)s)'
+                '    UNION'
+                '    SELECT edge.out_eid FROM edge JOIN descendant ON edge.in_eid = descendant.eid'
+                '    WHERE label IN (%(labels)s)'
+                ') ' % {'labels': _placeholders(labels)}, [root_eid] + labels * 2)
+
+
+    def get_subtree_rows(self, root_eid, labels):
+        labels = list(labels)
+        descendant_query, params = self._get_descendant_query(root_eid, labels)
+        query = (descendant_query +
+                 'SELECT edge.in_eid, vertex.eid, vertex.data FROM descendant '
+                 'JOIN vertex ON vertex.eid = descendant.eid '
+                 'JOIN edge ON edge.out_eid = descendant.eid AND edge.label IN (%s)' % _placeholders(labels))
+        rows = self._query(query, params + labels)
+        return [(parent_eid, eid, json.loads(data)) for parent_eid, eid, data in rows]
+
+
+    def get_descendant_rows(self, root_eid, depth):
+        if depth == 0:
+            # The closure has no paths of length 0, in cypher the only one
+            # leads to the root itself
+            rows = self._query('SELECT eid, data, 0 FROM vertex WHERE eid=?', (root_eid, ))
+            return [(eid, json.loads(data), depth) for eid, data, depth in rows]
+
+        query = ('SELECT vertex.eid, vertex.data, closure.depth FROM closure '
+                 'JOIN vertex ON vertex.eid = closure.descendant_eid '
+                 'WHERE closure.ancestor_eid=?')
+        params = [root_eid]
+        if depth is not None:
+            query += ' AND closure.depth=?'
+            params.append(depth)
+        rows = self._query(query + ' ORDER BY closure.depth', params)
+        return [(eid, json.loads(data), depth) for eid, data, depth in rows]
+
+
+    def count_descendants(self, root_eid):
+        ((count, ), ) = self._query('SELECT count(DISTINCT descendant_eid) FROM closure WHERE ancestor_eid=?', (root_eid, ))
+        return count
+
+
+    def get_level_rows(self, parent_eid, labels, after, limit):
+        labels = list(labels)
+        params = labels + [parent_eid] + labels
+        where = ''
+        if after is not None:
+            where = 'AND (label.value, vertex.eid) > (?, ?) '
+            params += list(after)
+        # A negative limit means no limit in sqlite
+        params.append(-1 if limit is None else limit)
+        # Count the grandchildren only for the children on this page
+        query = ('SELECT page.eid, page.data, '
+                 '       (SELECT count(*) FROM edge grandchild WHERE grandchild.in_eid = page.eid AND grandchild.label IN (%(labels)s)) '
+                 'FROM (SELECT vertex.eid, vertex.data, label.value AS label '
+                 '      FROM edge '
+                 '      JOIN vertex ON vertex.eid = edge.out_eid '
+                 "      LEFT JOIN vertex_property label ON label.eid = vertex.eid AND label.key='label' "
+                 '      WHERE edge.in_eid=? AND edge.label IN (%(labels)s) %(where)s'
+                 '      ORDER BY label.value, vertex.eid LIMIT ?) page '
+                 'ORDER BY page.label, page.eid' % {'labels': _placeholders(labels), 'where': where})
+        rows = self._query(query, params)
+        return [(eid, json.loads(data), count) for eid, data, count in rows]
+
+
+    def get_attribute_matrix_rows(self, root_eid, labels):
+        labels = list(labels)
+        descendant_query, params = self._get_descendant_query(root_eid, labels)
+        query = (descendant_query +
+                 'SELECT descendant.eid, attr_type.data, attribute.data, is_unit.in_eid FROM descendant '
+                 "JOIN edge has_attribute ON has_attribute.out_eid = descendant.eid AND has_attribute.label='HasAttribute' "
+                 'JOIN vertex attribute ON attribute.eid = has_attribute.in_eid '
+                 "JOIN edge has_attr_type ON has_attr_type.out_eid = attribute.eid AND has_attr_type.label='HasAttrType' "
+                 'JOIN vertex attr_type ON attr_type.eid = has_attr_type.in_eid '
+                 "JOIN edge is_unit ON is_unit.out_eid = attr_type.eid AND is_unit.label='IsUnit'")
+        rows = self._query(query, params)
+        attribute_rows = [(eid, json.loads(attr_type_data).get('label'), json.loads(attribute_data).get('value'), unit_eid)
+                          for eid, attr_type_data, attribute_data, unit_eid in rows]
+        return self.get_subtree_rows(root_eid, labels), attribute_rows
+
+
+    def get_connection_rows(self, system_eids):
+        systems = list(system_eids)
+        in_systems = 'IN (%s)' % _placeholders(systems)
+
+        # Connections of the systems, as (connection, system)
+        belongs_to = ('SELECT out_eid AS connection, in_eid AS system FROM edge '
+                      "WHERE label='BelongsTo' AND in_eid " + in_systems)
+
+        rows = self._query(
+            'SELECT belongs_to.system, connected_from.out_eid, belongs_to.connection, connection.data, '
+            '       child.eid, child.data '
+            'FROM (%s) belongs_to '
+            'JOIN vertex connection ON connection.eid = belongs_to.connection '
+            "JOIN edge connected_to ON connected_to.out_eid = belongs_to.connection AND connected_to.label='ConnectedTo' "
+            'JOIN vertex child ON child.eid = connected_to.in_eid '
+            "JOIN edge connected_from ON connected_from.in_eid = belongs_to.connection AND connected_from.label='ConnectedFrom'"
+            % belongs_to, systems)
+        connection_rows = [(system, parent, connection, json.loads(connection_data).get('quantity'),
+                            child, json.loads(child_data).get('label'))
+                           for system, parent, connection, connection_data, child, child_data in rows]
+
+        via_rows = self._query(
+            'SELECT belongs_to.connection, connected_via.in_eid FROM (%s) belongs_to '
+            "JOIN edge connected_via ON connected_via.out_eid = belongs_to.connection AND connected_via.label='ConnectedVia'"
+            % belongs_to, systems)
+
+        # Connectors of the systems and of all parts connected in them
+        parts = ('SELECT eid FROM vertex WHERE eid %s '
+                 'UNION '
+                 'SELECT connected_to.in_eid FROM (%s) belongs_to '
+                 "JOIN edge connected_to ON connected_to.out_eid = belongs_to.connection AND connected_to.label='ConnectedTo'"
+                 % (in_systems, belongs_to))
+        rows = self._query(
+            'SELECT has_connector.out_eid, connector.eid, connector.data, has_connector.data FROM (%s) part '
+            "JOIN edge has_connector ON has_connector.out_eid = part.eid AND has_connector.label='HasConnector' "
+            'JOIN vertex connector ON connector.eid = has_connector.in_eid'
+            % parts, systems * 2)
+        connector_rows = [(part, connector, json.loads(connector_data).get('label'), json.loads(edge_data).get('quantity'))
+                          for part, connector, connector_data, edge_data in rows]
+
+        # Connected parts which are systems themselves
+        system_rows = self._query(
+            'SELECT DISTINCT connected_to.in_eid FROM (%s) belongs_to '
+            "JOIN edge connected_to ON connected_to.out_eid = belongs_to.connection AND connected_to.label='ConnectedTo' "
+            "JOIN edge has_connection ON has_connection.out_eid = connected_to.in_eid AND has_connection.label='HasConnection'"
+            % belongs_to, systems)
+
+        return connection_rows, via_rows, connector_rows, system_rows
+
+
+    def get_attribute_keys(self):
+        rows = self._query(
+            'SELECT attribute.eid, attribute.data, attr_type.data FROM vertex attribute '
+            "JOIN edge ON edge.out_eid = attribute.eid AND edge.label='HasAttrType' "
+            'JOIN vertex attr_type ON attr_type.eid = edge.in_eid '
+            "WHERE attribute.element_type='Attribute'")
+        return [(eid, json.loads(data).get('value'), json.loads(attr_type_data).get('label'))
+                for eid, data, attr_type_data in rows]
+
+
+    def get_attribute_part_rows(self):
+        rows = self._query(
+            'SELECT attribute.eid, attribute.data, attr_type.data, is_unit.in_eid, part.eid, part.data FROM vertex attribute '
+            "JOIN edge has_attribute ON has_attribute.in_eid = attribute.eid AND has_attribute.label='HasAttribute' "
+            'JOIN vertex part ON part.eid = has_attribute.out_eid '
+            "JOIN edge has_attr_type ON has_attr_type.out_eid = attribute.eid AND has_attr_type.label='HasAttrType' "
+            'JOIN vertex attr_type ON attr_type.eid = has_attr_type.in_eid '
+            "JOIN edge is_unit ON is_unit.out_eid = attr_type.eid AND is_unit.label='IsUnit' "
+            "WHERE attribute.element_type='Attribute'")
+        l = []
+        for eid, data, attr_type_data, unit_eid, part_eid, part_data in rows:
+            data = json.loads(data)
+            l.append((eid, data.get('value'), data.get('number'), json.loads(attr_type_data).get('label'), unit_eid,
+                      part_eid, json.loads(part_data).get('label')))
+        return l
+
+
+    def get_edge_rows(self, label):
+        return self._query('SELECT out_eid, in_eid FROM edge WHERE label=?', (label, ))
+
+
+    def get_graph_rows(self):
+        vertex_rows = self._query('SELECT eid, data FROM vertex')
+        edge_rows = self._query('SELECT eid, label, out_eid, in_eid, data FROM edge')
+        return ([(eid, json.loads(data)) for eid, data in vertex_rows],
+                [(eid, label, out_eid, in_eid, json.loads(data)) for eid, label, out_eid, in_eid, data in edge_rows])
+
+
+    def write_bulk(self, nodes, edges, chunk_size):
+        """ Write all nodes and edges in one transaction, chunk_size is not
+        needed here """
+        with self._lock, self._conn:
+            for node in nodes:
+                node.eid = self._insert_vertex(node.element_type, dict(node.P, element_type=node.element_type))
+            for label, outV, inV, data in edges:
+                self._insert_edge(label, outV.eid, inV.eid, data)
@@ -1,7 +1,15 @@
+import sys
+import threading
+from operator import itemgetter
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
 import six
+import httplib2
 from bulbs.model import Relationship
-from bulbs.property import String, Integer, DateTime, Bool
+from bulbs.property import String, Integer, Float, DateTime, Bool
 from bulbs.model import Node as BulbsNode
+from bulbs.utils import initialize_elements
 
 
 
@@ -29,20 +37,17 @@ class _NodeProxy(object):
             if self._bulbs_proxy.index.lookup(name, value):
                 raise Exception('Duplicate entry %s' % kwargs['label'])
         bulbs_node = self._bulbs_proxy.create(**kwargs)
-        return self._cls(self._g, bulbs_node)
+        self._g.cache.invalidate_index(self._g.names[self._cls])
+        return self._g._wrap(self._g._compact(bulbs_node))
 
 
     def get_one(self, **kwargs):
-        res = self.get_all(**kwargs)
+        res = list(self.get_all(**kwargs))
         if not res:
             raise Exception('Found no %s with %r' % (self._cls.__name__, kwargs))
-        el = res.next()
-        try:
-            res.next()
-        except StopIteration:
-            return el
-        else:
+        if len(res) > 1:
             raise Exception('Found multiple (%s) %s with %r' % (len(res), self._cls.__name__, kwargs))
+        return res[0]
 
 
     def get_all(self, **kwargs):
@@ -50,10 +55,514 @@ class _NodeProxy(object):
             if len(kwargs) > 1:
                 raise Exception('Not supported, doesnt work with bulbs')
             name, value = kwargs.items()[0]
-            i = self._bulbs_proxy.index.lookup(name, value)
+            key = ('index', self._g.names[self._cls], name, value)
         else:
-            i = self._bulbs_proxy.get_all()
-        return (self._cls(self._g, o) for o in i) if i else []
+            key = ('index', self._g.names[self._cls])
+
+        cache = self._g.cache
+        eids = cache.get(key)
+        if eids is None:
+            if kwargs:
+                i = self._bulbs_proxy.index.lookup(name, value)
+            else:
+                i = self._bulbs_proxy.get_all()
+            eids = []
+            for o in i or []:
+                cache.set(('vertex', o.eid), self._g._compact(o))
+                eids.append(o.eid)
+            cache.set(key, eids)
+
+        return (self._g._get_node(eid) for eid in eids) if eids else []
+
+
+
+def _estimate_size(obj, _depth=0):
+    """ Rough estimation of the memory used by obj and the objects it
+    contains. Bulbs elements are measured by their property data """
+    size = sys.getsizeof(obj)
+    if _depth > 3:
+        return size
+
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, (list, tuple, set)):
+        items = obj
+    elif isinstance(obj, CompactVertex):
+        items = (obj.values,)
+    elif hasattr(obj, '_data'):
+        items = (obj._data,)
+    else:
+        items = ()
+
+    for item in items:
+        size += _estimate_size(item, _depth + 1)
+    return size
+
+
+
+class GraphCache(object):
+    """ In-process LRU cache for vertices, index lookups and adjacency lists
+
+    Keys are tuples, the first item is the kind of the entry:
+      ('vertex', eid) -> CompactVertex
+      ('index', element_type[, property_name, value]) -> list of eids
+      ('adjacency', eid, direction, edge_label) -> list of eids
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        # max_size is the memory budget in bytes
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # element_type -> set of the keys of its index entries
+        self._index_keys = {}
+        self._lock = threading.RLock()
+
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Reinsert to mark the entry as recently used
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+
+    def set(self, key, value):
+        size = _estimate_size(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            if key[0] == 'index':
+                self._index_keys.setdefault(key[1], set()).add(key)
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+            if key[0] == 'index':
+                self._index_keys[key[1]].discard(key)
+
+
+    def invalidate(self, func):
+        """ Remove all entries for which func(key, value) is true """
+        with self._lock:
+            for key, (value, size) in self._entries.items():
+                if func(key, value):
+                    self._remove(key)
+
+
+    def invalidate_vertex(self, eid):
+        with self._lock:
+            self._remove(('vertex', eid))
+
+
+    def invalidate_index(self, element_type):
+        with self._lock:
+            for key in list(self._index_keys.get(element_type, ())):
+                self._remove(key)
+
+
+    def invalidate_edge(self, out_eid, in_eid, label):
+        with self._lock:
+            self._remove(('adjacency', out_eid, 'out', label))
+            self._remove(('adjacency', in_eid, 'in', label))
+
+
+    def invalidate_deleted_vertex(self, eid):
+        """ Remove the vertex and every entry referencing it """
+        def _references(key, value):
+            if key[0] == 'vertex':
+                return key[1] == eid
+            return (key[0] == 'adjacency' and key[1] == eid) or eid in value
+        self.invalidate(_references)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index_keys.clear()
+            self.size = 0
+
+
+    def get_stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._entries),
+                        size=self.size, max_size=self.max_size)
+
+
+
+class AncestorIndex(object):
+    """ The IsA ancestors of every vertex as a tuple of eids with the root
+    first (materialized paths). Built from all IsA edges at once, creating
+    an IsA edge updates the paths of the moved subtree. Deleting a vertex
+    which is part of the index drops it, it is built again when needed """
+
+    def __init__(self):
+        # eid -> tuple of ancestor eids, None if not built
+        self._paths = None
+        # eid -> list of child eids
+        self._children = None
+        self._lock = threading.RLock()
+
+
+    def build(self, rows):
+        """ rows are (child eid, parent eid) of all IsA edges """
+        parents = {}
+        children = {}
+        for child_eid, parent_eid in rows:
+            parents[child_eid] = parent_eid
+            children.setdefault(parent_eid, []).append(child_eid)
+
+        paths = {}
+        for eid in parents:
+            # Walk up to the root or a vertex with a known path, then set
+            # the paths on the way back
+            chain = []
+            seen = set()
+            while eid not in paths:
+                parent_eid = parents.get(eid)
+                if parent_eid is None or parent_eid in seen:
+                    paths[eid] = ()
+                    break
+                seen.add(eid)
+                chain.append(eid)
+                eid = parent_eid
+            for child_eid in reversed(chain):
+                paths[child_eid] = paths[eid] + (eid, )
+                eid = child_eid
+
+        with self._lock:
+            self._paths = paths
+            self._children = children
+
+
+    def get(self, eid):
+        """ Returns the ancestors of eid, None if the index is not built """
+        with self._lock:
+            if self._paths is None:
+                return None
+            return self._paths.get(eid, ())
+
+
+    def add_edge(self, child_eid, parent_eid):
+        with self._lock:
+            if self._paths is None:
+                return
+            # A vertex has one parent, the subtree of child_eid moves away
+            # from its old parent
+            old_path = self._paths.get(child_eid)
+            if old_path:
+                self._children[old_path[-1]].remove(child_eid)
+            self._children.setdefault(parent_eid, []).append(child_eid)
+            self._paths[child_eid] = self._paths.get(parent_eid, ()) + (parent_eid, )
+            stack = [child_eid]
+            while stack:
+                eid = stack.pop()
+                for grandchild_eid in self._children.get(eid, []):
+                    self._paths[grandchild_eid] = self._paths[eid] + (eid, )
+                    stack.append(grandchild_eid)
+
+
+    def remove_vertex(self, eid):
+        with self._lock:
+            if self._paths is not None and (eid in self._paths or eid in self._children):
+                self.clear()
+
+
+    def clear(self):
+        with self._lock:
+            self._paths = None
+            self._children = None
+
+
+
+def _normalize_eid(eid):
+    # eids from forms and urls are strings, neo4j uses integers
+    try:
+        return int(eid)
+    except ValueError:
+        return eid
+
+
+
+def _chunks(l, size):
+    for i in xrange(0, len(l), size):
+        yield l[i:i + size]
+
+
+
+class _ThreadLocalHttp(object):
+    """ Replaces the httplib2.Http of a bulbs client, which must not be used
+    by more than one thread. Each thread gets its own Http which keeps its
+    connection to the server alive and has the credentials of the client """
+
+    def __init__(self, username=None, password=None):
+        self._local = threading.local()
+        self._credentials = []
+        if username and password:
+            self._credentials.append((username, password))
+
+
+    def _get_http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = httplib2.Http()
+            for username, password in self._credentials:
+                http.add_credentials(username, password)
+        return http
+
+
+    def add_credentials(self, username, password):
+        self._credentials.append((username, password))
+        self._get_http().add_credentials(username, password)
+
+
+    def request(self, *args, **kwargs):
+        return self._get_http().request(*args, **kwargs)
+
+
+
+class BulbsBackend(object):
+    """ Storage backend for a neo4j server, accessed with bulbs. The
+    traversal queries use cypher and the neo4j batch endpoint.
+
+    A backend provides proxies for node and relationship classes (create(),
+    get_all(), index.lookup()) and vertices with properties as attributes,
+    save(), inV() and outV(), as bulbs does """
+
+    def __init__(self, bulbs_graph):
+        self.bg = bulbs_graph
+        self._proxies = {}
+        # Graph.run_parallel() sends requests from several threads
+        config = self.bg.client.request.config
+        self.bg.client.request.http = _ThreadLocalHttp(config.username, config.password)
+
+
+    def add_node_class(self, name, cls):
+        dct = cls.properties.copy()
+        dct['element_type'] = name
+        dct['__mode__'] = 'STRICT'
+        bubls_node_cls = type(name, (BulbsNode, ), dct)
+        self.bg.add_proxy(name, bubls_node_cls)
+        bulbs_proxy = getattr(self.bg, name)
+        self._proxies[name] = bulbs_proxy
+        return bulbs_proxy
+
+
+    def add_relationship_class(self, name, rel_cls):
+        self.bg.add_proxy(name, rel_cls)
+        return getattr(self.bg, name)
+
+
+    def get_vertex(self, eid):
+        return self.bg.vertices.get(eid)
+
+
+    def get_adjacent(self, eid, direction, label):
+        # As bulbs_vertex.outV(label), without fetching the vertex first
+        response = getattr(self.bg.client, direction + 'V')(eid, label)
+        return initialize_elements(self.bg.client, response) or []
+
+
+    def update_vertex(self, element_type, eid, data):
+        return self._proxies[element_type].update(eid, data)
+
+
+    def delete_vertex(self, eid):
+        self.bg.vertices.delete(eid)
+
+
+    def delete_edge(self, eid):
+        self.bg.edges.delete(eid)
+
+
+    def clear(self):
+        self.bg.clear()
+
+
+    def _batch(self, jobs):
+        """ Send several REST requests with the neo4j batch endpoint, returns
+        the results in the order of the jobs """
+        results = self.bg.client.request.post('batch', jobs).content
+        return sorted(results, key=itemgetter('id'))
+
+
+    def _cypher_batch(self, queries):
+        """ Run a list of (query, params) with a single request, returns a
+        list with the rows of each query """
+        jobs = []
+        for i, (query, params) in enumerate(queries):
+            jobs.append({'method': 'POST', 'to': '/cypher', 'body': {'query': query, 'params': params}, 'id': i})
+        return [result['body']['data'] for result in self._batch(jobs)]
+
+
+    def _get_subtree_query(self, labels):
+        return ('START root=node({eid}) '
+                'MATCH root<-[:%(labels)s*]-child-[:%(labels)s]->parent '
+                'RETURN ID(parent), ID(child), child' % {'labels': '|'.join(labels)})
+
+
+    def get_subtree_rows(self, root_eid, labels):
+        columns, rows = self.bg.cypher.table(self._get_subtree_query(labels), dict(eid=root_eid))
+        return ((parent_eid, eid, node['data']) for parent_eid, eid, node in rows)
+
+
+    def get_descendant_rows(self, root_eid, depth):
+        length = '*' if depth is None else '*%d..%d' % (depth, depth)
+        query = ('START root=node({eid}) '
+                 'MATCH path=root<-[:IsA%s]-descendant '
+                 'RETURN ID(descendant), descendant, length(path) '
+                 'ORDER BY length(path)' % length)
+        columns, rows = self.bg.cypher.table(query, dict(eid=root_eid))
+        return [(eid, node['data'], depth) for eid, node, depth in rows]
+
+
+    def count_descendants(self, root_eid):
+        columns, rows = self.bg.cypher.table('START root=node({eid}) '
+                                             'MATCH root<-[:IsA*]-descendant '
+                                             'RETURN count(DISTINCT descendant)', dict(eid=root_eid))
+        ((count, ), ) = rows
+        return count
+
+
+    def get_level_rows(self, parent_eid, labels, after, limit):
+        params = dict(eid=parent_eid, limit=limit)
+        query = ('START parent=node({eid}) '
+                 'MATCH parent<-[:%(labels)s]-child<-[?:%(labels)s]-grandchild ' % {'labels': '|'.join(labels)})
+        if after is not None:
+            query += ('WHERE child.label > {after_label} OR '
+                      '(child.label = {after_label} AND ID(child) > {after_eid}) ')
+            params['after_label'], params['after_eid'] = after
+        query += ('RETURN ID(child), child, child.label, count(grandchild) '
+                  'ORDER BY child.label, ID(child)')
+        if limit is not None:
+            query += ' LIMIT {limit}'
+        columns, rows = self.bg.cypher.table(query, params)
+        return [(eid, node['data'], count) for eid, node, label, count in rows]
+
+
+    def get_attribute_matrix_rows(self, root_eid, labels):
+        params = dict(eid=root_eid)
+        subtree_rows, attribute_rows = self._cypher_batch([
+            (self._get_subtree_query(labels), params),
+            ('START root=node({eid}) '
+             'MATCH root<-[:%s*]-part-[:HasAttribute]->attribute-[:HasAttrType]->attr_type-[:IsUnit]->unit '
+             'RETURN DISTINCT ID(part), attr_type.label, attribute.value, ID(unit)' % '|'.join(labels), params),
+        ])
+        return [(parent_eid, eid, node['data']) for parent_eid, eid, node in subtree_rows], attribute_rows
+
+
+    def get_connection_rows(self, system_eids):
+        params = dict(systems=list(system_eids))
+        (connection_rows, via_rows, system_connector_rows, connector_rows, system_rows) = self._cypher_batch([
+            ('START system=node({systems}) '
+             'MATCH system<-[:BelongsTo]-connection-[:ConnectedTo]->child, '
+             '      parent-[:ConnectedFrom]->connection '
+             'RETURN ID(system), ID(parent), ID(connection), connection.quantity, ID(child), child.label', params),
+            ('START system=node({systems}) '
+             'MATCH system<-[:BelongsTo]-connection-[:ConnectedVia]->connector '
+             'RETURN ID(connection), ID(connector)', params),
+            # Connectors of the systems and of all parts connected in them
+            ('START part=node({systems}) '
+             'MATCH part-[has_connector:HasConnector]->connector '
+             'RETURN ID(part), ID(connector), connector.label, has_connector.quantity', params),
+            ('START system=node({systems}) '
+             'MATCH system<-[:BelongsTo]-connection-[:ConnectedTo]->part-[has_connector:HasConnector]->connector '
+             'RETURN DISTINCT ID(part), ID(connector), connector.label, has_connector.quantity', params),
+            # Connected parts which are systems themselves
+            ('START system=node({systems}) '
+             'MATCH system<-[:BelongsTo]-connection-[:ConnectedTo]->child-[:HasConnection]->root '
+             'RETURN DISTINCT ID(child)', params),
+        ])
+        return connection_rows, via_rows, system_connector_rows + connector_rows, system_rows
+
+
+    def get_attribute_keys(self):
+        query = ('START attribute=node:%s(element_type="Attribute") '
+                 'MATCH attribute-[:HasAttrType]->attr_type '
+                 'RETURN ID(attribute), attribute.value, attr_type.label' % self._proxies['Attribute'].index.index_name)
+        columns, rows = self.bg.cypher.table(query)
+        return rows
+
+
+    def get_attribute_part_rows(self):
+        query = ('START attribute=node:%s(element_type="Attribute") '
+                 'MATCH part-[:HasAttribute]->attribute-[:HasAttrType]->attr_type-[:IsUnit]->unit '
+                 'RETURN ID(attribute), attribute.value, attribute.number?, attr_type.label, ID(unit), ID(part), part.label' % self._proxies['Attribute'].index.index_name)
+        columns, rows = self.bg.cypher.table(query)
+        return rows
+
+
+    def get_edge_rows(self, label):
+        columns, rows = self.bg.cypher.table('START n=node(*) MATCH n-[:%s]->m RETURN ID(n), ID(m)' % label)
+        return rows
+
+
+    def get_graph_rows(self):
+        vertex_rows, edge_rows = self._cypher_batch([
+            ('START n=node(*) RETURN ID(n), n', {}),
+            ('START n=node(*) MATCH n-[r]->m RETURN ID(r), type(r), ID(n), ID(m), r', {}),
+        ])
+        return ([(eid, node['data']) for eid, node in vertex_rows],
+                [(eid, label, out_eid, in_eid, rel['data']) for eid, label, out_eid, in_eid, rel in edge_rows])
+
+
+    def _write_nodes(self, nodes):
+        jobs = []
+        for i, node in enumerate(nodes):
+            data = dict(node.P, element_type=node.element_type)
+            jobs.append({'method': 'POST', 'to': '/node', 'body': data, 'id': i})
+
+        # bulbs indexes all properties of a node in the index of its class,
+        # get_all() looks nodes up by element_type
+        for i, node in enumerate(nodes):
+            index_name = self._proxies[node.element_type].index.index_name
+            for key, value in jobs[i]['body'].iteritems():
+                jobs.append({'method': 'POST',
+                             'to': '/index/node/%s' % index_name,
+                             'body': {'key': key, 'value': value, 'uri': '{%s}' % i},
+                             'id': len(jobs)})
+
+        for result in self._batch(jobs):
+            if result['id'] < len(nodes):
+                nodes[result['id']].eid = int(result['location'].rsplit('/', 1)[1])
+
+
+    def _write_edges(self, edges):
+        root_uri = self.bg.config.root_uri.rstrip('/')
+        jobs = []
+        for label, outV, inV, data in edges:
+            jobs.append({'method': 'POST',
+                         'to': '/node/%s/relationships' % outV.eid,
+                         'body': {'to': '%s/node/%s' % (root_uri, inV.eid), 'type': label, 'data': data},
+                         'id': len(jobs)})
+        self._batch(jobs)
+
+
+    def write_bulk(self, nodes, edges, chunk_size):
+        """ Write nodes, then edges, chunk_size elements per batch request """
+        for chunk in _chunks(nodes, chunk_size):
+            self._write_nodes(chunk)
+        for chunk in _chunks(edges, chunk_size):
+            self._write_edges(chunk)
+
+
+
+# Number of threads of Graph.run_parallel()
+READ_THREADS = 8
 
 
 
@@ -61,10 +570,20 @@ class Graph(object):
     def __init__(self):
         self.classes = {}
         self.names = {}
+        self.cache = GraphCache()
+        self.ancestors = AncestorIndex()
+        # Identity map of the current thread, see start_identity_map()
+        self._local = threading.local()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+
+    def set_backend(self, backend):
+        self.backend = backend
 
 
     def set_bulbs_graph(self, bulbs_graph):
-        self._bg = bulbs_graph
+        self.set_backend(BulbsBackend(bulbs_graph))
 
 
     def set_proxy(self, cls, name, bulbs_proxy):
@@ -73,13 +592,7 @@ class Graph(object):
 
 
     def _make_bulbs_node(self, name, cls):
-        dct = cls.properties.copy()
-        dct['element_type'] = name
-        dct['__mode__'] = 'STRICT'
-        bubls_node_cls = type(name, (BulbsNode, ), dct)
-        self._bg.add_proxy(name, bubls_node_cls)
-        bulbs_proxy = getattr(self._bg, cls.__name__)
-        return bulbs_proxy
+        return self.backend.add_node_class(name, cls)
 
 
     def register_class(self, cls, name=None):
@@ -96,17 +609,213 @@ class Graph(object):
         self.set_proxy(cls, name, bulbs_proxy)
 
 
+    def _compact(self, vertex):
+        """ Returns a CompactVertex with the properties of a vertex of the
+        backend """
+        cls = self.classes[vertex.element_type]
+        return CompactVertex(vertex.eid, vertex.element_type,
+                             [getattr(vertex, name, None) for name in cls._property_names])
+
+
+    def _get_vertex(self, eid):
+        key = ('vertex', eid)
+        vertex = self.cache.get(key)
+        if vertex is None:
+            bulbs_node = self.backend.get_vertex(eid)
+            if bulbs_node is not None:
+                vertex = self._compact(bulbs_node)
+                self.cache.set(key, vertex)
+        return vertex
+
+
+    def save_vertex(self, vertex):
+        """ Write the properties of a CompactVertex to the backend, they are
+        updated with the stored (coerced) values """
+        cls = self.classes[vertex.element_type]
+        saved = self.backend.update_vertex(vertex.element_type, vertex.eid, dict(zip(cls._property_names, vertex.values)))
+        vertex.values[:] = self._compact(saved).values
+
+
+    def start_identity_map(self):
+        """ Until clear_identity_map() is called, every vertex is wrapped only
+        once in the current thread, later lookups of its eid return the same
+        Node without fetching the vertex again. Used for the duration of a
+        request """
+        self._local.nodes = {}
+
+
+    def clear_identity_map(self):
+        self._local.nodes = None
+
+
+    def _wrap(self, vertex):
+        nodes = getattr(self._local, 'nodes', None)
+        if nodes is not None and vertex.eid in nodes:
+            return nodes[vertex.eid]
+
+        cls = self.classes[vertex.element_type]
+        # The node changes its own copy of the cached values, other readers
+        # only see the changes after they were saved
+        node = cls(self, CompactVertex(vertex.eid, vertex.element_type, list(vertex.values)))
+        if nodes is not None:
+            # The map may be shared with other threads, see run_parallel()
+            node = nodes.setdefault(node.eid, node)
+        return node
+
+
+    def _get_node(self, eid):
+        nodes = getattr(self._local, 'nodes', None)
+        if nodes is not None and eid in nodes:
+            return nodes[eid]
+
+        vertex = self._get_vertex(eid)
+        if vertex is None:
+            return None
+        return self._wrap(vertex)
+
+
     def get_from_eid(self, eid):
         assert eid is not None
-        bulbs_node = self._bg.vertices.get(eid)
-        if bulbs_node is None:
-            return None
-        cls = self.classes[bulbs_node.element_type]
-        return cls(self, bulbs_node)
+        return self._get_node(_normalize_eid(eid))
+
+
+    def get_adjacent(self, node, direction, label):
+        """ Returns the nodes connected to node by edges with label.
+        direction is 'in' or 'out' """
+        key = ('adjacency', node.eid, direction, label)
+        eids = self.cache.get(key)
+        if eids is None:
+            eids = []
+            for bulbs_node in self.backend.get_adjacent(node.eid, direction, label):
+                self.cache.set(('vertex', bulbs_node.eid), self._compact(bulbs_node))
+                eids.append(bulbs_node.eid)
+            self.cache.set(key, eids)
+        return [self._get_node(eid) for eid in eids]
+
+
+    def run_parallel(self, *funcs):
+        """ Call the functions in a pool of threads and return their results in
+        the same order. The functions must only read from the graph, they
+        share the identity map of the calling thread. Calls from within the
+        pool run one after the other, so they never wait for a busy pool """
+        if len(funcs) < 2 or getattr(self._local, 'in_pool', False):
+            return [func() for func in funcs]
+
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(READ_THREADS)
+
+        nodes = getattr(self._local, 'nodes', None)
+        def _call(func):
+            self._local.nodes = nodes
+            self._local.in_pool = True
+            try:
+                return func()
+            finally:
+                self._local.nodes = None
+                self._local.in_pool = False
+
+        results = [self._pool.apply_async(_call, (func, )) for func in funcs]
+        # get() raises the exception of a failed function
+        return [result.get() for result in results]
+
+
+    def get_connections(self, system_eids):
+        """ Load the connections of the given systems and of all systems
+        contained in them. Each level of nested systems costs one batch
+        request """
+        connections = SystemConnections()
+        system_eids = set(system_eids)
+        while system_eids:
+            rows = self.backend.get_connection_rows(system_eids)
+            connections.loaded_systems.update(system_eids)
+            connections.add(*rows)
+            system_eids = connections.systems - connections.loaded_systems
+        return connections
+
+
+    def get_attribute_keys(self):
+        """ Returns (attribute eid, value, attr_type label) rows for all
+        attributes, fetched with a single query """
+        return self.backend.get_attribute_keys()
+
+
+    def get_attribute_parts(self):
+        """ Returns (attribute eid, value, number, attr_type label, unit eid,
+        part eid, part label) rows for all attributes of all parts, fetched
+        with a single query """
+        return self.backend.get_attribute_part_rows()
+
+
+    def get_graph_rows(self):
+        """ Returns all vertices as (eid, properties) and all edges as (eid,
+        label, out eid, in eid, properties) rows """
+        return self.backend.get_graph_rows()
+
+
+    def delete_vertex(self, eid):
+        self.backend.delete_vertex(eid)
+        self.cache.invalidate_deleted_vertex(eid)
+        self.ancestors.remove_vertex(eid)
+        nodes = getattr(self._local, 'nodes', None)
+        if nodes is not None:
+            nodes.pop(eid, None)
+
+
+    def get_ancestor_eids(self, eid):
+        """ Returns the eids of the vertices connected to eid by a chain of
+        outgoing IsA edges, the root first. The first call loads all IsA
+        edges with one query, later calls need no query """
+        eid = _normalize_eid(eid)
+        eids = self.ancestors.get(eid)
+        if eids is None:
+            self.ancestors.build(self.backend.get_edge_rows('IsA'))
+            eids = self.ancestors.get(eid)
+        return eids
+
+
+    def get_subtree(self, root, labels):
+        """ Fetch all vertices which are connected to root by a chain of
+        incoming edges with one of the given labels. Only one query is sent
+        to the server, the tree is assembled in memory """
+        return Subtree(root.eid, self.backend.get_subtree_rows(root.eid, labels))
+
+
+    def get_level(self, parent_eid, labels, after=None, limit=None):
+        """ Returns (eid, properties, number of children) for the vertices
+        connected to parent_eid by an incoming edge with one of the given
+        labels, ordered by label and eid. If after is a (label, eid) tuple
+        only the vertices following it are returned """
+        return self.backend.get_level_rows(parent_eid, labels, after, limit)
+
+
+    def get_descendants(self, eid, depth=None):
+        """ Returns (eid, properties, depth) for the vertices connected to eid
+        by a chain of incoming IsA edges, ordered by depth. With depth only
+        the vertices this number of edges away, depth=0 returns eid itself.
+        eid is not included otherwise """
+        return self.backend.get_descendant_rows(_normalize_eid(eid), depth)
+
+
+    def count_descendants(self, eid):
+        return self.backend.count_descendants(_normalize_eid(eid))
+
+
+    def get_attribute_matrix(self, root, labels=('IsA', )):
+        """ Like get_subtree(), together with the formatted attributes of all
+        vertices. Both are fetched with one request """
+        (subtree_rows, attribute_rows), formats = self.run_parallel(
+            lambda: self.backend.get_attribute_matrix_rows(root.eid, labels),
+            lambda: dict((unit.eid, unit.P.format) for unit in self.Unit.get_all()))
+        return AttributeMatrix(Subtree(root.eid, subtree_rows), attribute_rows, formats)
 
 
     def clear(self):
-        self._bg.clear()
+        self.backend.clear()
+        self.cache.clear()
+        self.ancestors.clear()
+        if getattr(self._local, 'nodes', None) is not None:
+            self.start_identity_map()
         for name, cls in self.classes.iteritems():
             bulbs_proxy = self._make_bulbs_node(name, cls)
             self.set_proxy(cls, name, bulbs_proxy)
@@ -116,27 +825,135 @@ g = Graph()
 
 
 
+class Subtree(object):
+    """ Vertices below a root vertex, indexed by the eid of their parent """
+    def __init__(self, root_eid, rows):
+        self.root_eid = root_eid
+        self._children = {}
+        seen = set()
+        for parent_eid, eid, properties in rows:
+            # Variable length matches return an edge once per path
+            if (parent_eid, eid) in seen:
+                continue
+            seen.add((parent_eid, eid))
+            self._children.setdefault(parent_eid, []).append((eid, properties))
+
+
+    def get_children(self, eid=None):
+        """ Returns a list of (eid, properties) tuples """
+        if eid is None:
+            eid = self.root_eid
+        return self._children.get(eid, [])
+
+
+
+class AttributeMatrix(object):
+    """ Parts of a subtree in depth first order and their attributes, as
+    attr type label -> value formatted with the format of its unit """
+    def __init__(self, subtree, attribute_rows, formats):
+        self.parts = []
+        self._values = {}
+        attr_types = set()
+        for part_eid, attr_type_label, value, unit_eid in attribute_rows:
+            self._values.setdefault(part_eid, {})[attr_type_label] = formats[unit_eid] % {'unit': value}
+            attr_types.add(attr_type_label)
+        self.attr_types = sorted(attr_types)
+
+        stack = list(reversed(subtree.get_children()))
+        while stack:
+            eid, properties = stack.pop()
+            self.parts.append((eid, properties))
+            stack.extend(reversed(subtree.get_children(eid)))
+
+
+    def get_attributes(self, eid):
+        return self._values.get(eid, {})
+
+
+
+class SystemConnections(object):
+    """ Connections of systems, the parts they connect and the connectors of
+    these parts """
+    def __init__(self):
+        # (system eid, parent part eid) -> list of dicts
+        self._connections = {}
+        # part eid -> list of (connector eid, connector label, quantity)
+        self._connectors = {}
+        # Parts which are the root of a system
+        self.systems = set()
+        self.loaded_systems = set()
+
+
+    def add(self, connection_rows, via_rows, connector_rows, system_rows):
+        via = dict(via_rows)
+        for system_eid, parent_eid, eid, quantity, child_eid, child_label in connection_rows:
+            self._connections.setdefault((system_eid, parent_eid), []).append({
+                'eid': eid,
+                'quantity': quantity,
+                'child_eid': child_eid,
+                'child_label': child_label,
+                'connector_eid': via.get(eid),
+            })
+
+        for part_eid, connector_eid, label, quantity in connector_rows:
+            connectors = self._connectors.setdefault(part_eid, [])
+            if (connector_eid, label, quantity) not in connectors:
+                connectors.append((connector_eid, label, quantity))
+
+        self.systems.update(eid for (eid,) in system_rows)
+
+
+    def get_connections(self, system_eid, part_eid):
+        return self._connections.get((system_eid, part_eid), [])
+
+
+    def get_connectors(self, part_eid):
+        return self._connectors.get(part_eid, [])
+
+
+
+class CompactVertex(object):
+    """ A vertex as kept in the GraphCache: the values of its properties in
+    the order of _property_names of its node class. It needs a fraction of
+    the memory of a bulbs vertex, which is only used for writing """
+    __slots__ = ('eid', 'element_type', 'values')
+
+    def __init__(self, eid, element_type, values):
+        self.eid = eid
+        self.element_type = element_type
+        self.values = values
+
+    def __repr__(self):
+        return '<CompactVertex %s %s %r>' % (self.element_type, self.eid, self.values)
+
+
+
 class Properties(object):
-    def __init__(self, bulbs_node, allowed_properties):
-        object.__setattr__(self, '_bnode', bulbs_node)
-        object.__setattr__(self, '_allowed_properties', allowed_properties)
+    """ Access to the values of a CompactVertex by property name, indexes
+    maps the names to the positions of the values """
+    __slots__ = ('_vertex', '_indexes')
+
+    def __init__(self, vertex, indexes):
+        object.__setattr__(self, '_vertex', vertex)
+        object.__setattr__(self, '_indexes', indexes)
 
     def __str__(self):
-        return str(self._bnode)
+        return str(dict((name, self._vertex.values[i]) for name, i in self._indexes.iteritems()))
 
     def __getattr__(self, name):
-        return getattr(self._bnode, name, None)
+        i = self._indexes.get(name)
+        return None if i is None else self._vertex.values[i]
 
     def __setattr__(self, name, value):
-        if not name in self._allowed_properties:
-            raise AttributeError('Attribute %s not allowed for this node. Allowed attributes: %r' % (name, self._allowed_attributes))
-        setattr(self._bnode, name, value)
+        if not name in self._indexes:
+            raise AttributeError('Attribute %s not allowed for this node. Allowed attributes: %r' % (name, sorted(self._indexes)))
+        self._vertex.values[self._indexes[name]] = value
 
     __getitem__ = __getattr__
     __setitem__ = __setattr__
 
     def __contains__(self, name):
-        return name in self._allowed_properties
+        return name in self._indexes
 
 
 
@@ -157,11 +974,16 @@ class NodeMeta(type):
                     raise Exception('Multiple unique properties %s, %s in %s. Only one unique property is allowed at the moment. Bulbs does not allow to select nodes more than one property' % (unique, key, name))
                 unique = key
 
+        # The values of a CompactVertex are in this order
+        dct['_property_names'] = tuple(sorted(properties))
+        dct['_property_indexes'] = dict((key, i) for i, key in enumerate(dct['_property_names']))
+        dct.setdefault('__slots__', ())
         return super(NodeMeta, meta).__new__(meta, name, bases, dct)
 
 
 
 class Node(six.with_metaclass(NodeMeta, object)):
+    __slots__ = ('P', 'eid', 'g', '_vertex')
     properties = {}
     _bulbs_proxy = None
 
@@ -175,13 +997,12 @@ class Node(six.with_metaclass(NodeMeta, object)):
         return l
 
 
-    def __init__(self, graph, bulbs_node, **kwargs):
-        self.P = Properties(bulbs_node, self.properties)
-        self.update(**kwargs)
-        self.E = bulbs_node
-        self.eid = self.P['eid']
-        self._bulbs_node = bulbs_node
+    def __init__(self, graph, vertex, **kwargs):
+        self.P = Properties(vertex, self._property_indexes)
+        self.eid = vertex.eid
+        self._vertex = vertex
         self.g = graph
+        self.update(**kwargs)
 
 
     def __str__(self):
@@ -192,7 +1013,7 @@ class Node(six.with_metaclass(NodeMeta, object)):
 
 
     def __eq__(self, node):
-        return self._bulbs_node == node._bulbs_node
+        return self.eid == node.eid
 
 
     def get_proxy(self):
@@ -220,7 +1041,30 @@ class Node(six.with_metaclass(NodeMeta, object)):
 
 
     def save(self):
-        self._bulbs_node.save()
+        self.g.save_vertex(self._vertex)
+        self._invalidate_cache()
+
+
+    def _invalidate_cache(self):
+        self.g.cache.invalidate_vertex(self.eid)
+        self.g.cache.invalidate_index(self.g.names[self.__class__])
+
+
+    def inV(self, label):
+        return self.g.get_adjacent(self, 'in', label)
+
+
+    def outV(self, label):
+        return self.g.get_adjacent(self, 'out', label)
+
+
+    def get_ancestors(self):
+        """ Returns the IsA ancestors of the node, the root first """
+        return [self.g.get_from_eid(eid) for eid in self.g.get_ancestor_eids(self.eid)]
+
+
+    def is_descendant_of(self, node):
+        return node.eid in self.g.get_ancestor_eids(self.eid)
 
 
 
@@ -254,24 +1098,30 @@ def get_node_classes():
         )
 
     class Attribute(Node):
+        # value as imported, the value is additionally stored in one of
+        # the typed properties if the unit of the attr type has a type
         properties = dict(
-            value = String(nullable=False)
+            value = String(nullable=False),
+            number = Float(),
+            date = String(), # YYYY-MM-DD
+            flag = Bool(),
         )
 
     class Unit(LabeledNode):
         properties = dict(
             name = String(nullable=False),
             format = String(nullable=False),
+            value_type = String(), # number, date, bool or None
         )
 
         def get_attr_types(self):
-            return self.E.inV('IsUnit') or []
+            return self.inV('IsUnit')
 
         def delete(self):
             if self.get_attr_types():
                 raise Exception('Could not delete')
             else:
-                g.vertices.delete(self.eid)
+                self.g.delete_vertex(self.eid)
 
     return locals().values()
 
@@ -287,7 +1137,11 @@ class _RelationshipBase(Relationship):
 
     @classmethod
     def create(cls, outV, inV, **kwargs):
-        return cls._bulbs_proxy.create(outV._bulbs_node, inV._bulbs_node, None, **kwargs)
+        edge = cls._bulbs_proxy.create(outV.eid, inV.eid, None, **kwargs)
+        outV.g.cache.invalidate_edge(outV.eid, inV.eid, cls.__name__)
+        if cls.__name__ == 'IsA':
+            outV.g.ancestors.add_edge(outV.eid, inV.eid)
+        return edge
 
 
 def init_relationship_classes():
@@ -310,6 +1164,73 @@ def init_relationship_classes():
     R.update(locals())
 
 
+class _PendingProperties(dict):
+    def __getattr__(self, name):
+        return self.get(name)
+
+
+
+class _PendingNode(object):
+    """ Node created by a BulkLoader, eid is set when the loader is flushed """
+    def __init__(self, cls, element_type, data):
+        self.properties = cls.properties
+        self.element_type = element_type
+        self.P = _PendingProperties(data)
+        self.eid = None
+
+
+
+class BulkLoader(object):
+    """ Collects nodes and relationships in memory and writes them at once,
+    with neo4j in batch requests of chunk_size elements """
+
+    def __init__(self, graph, chunk_size=1000):
+        self._g = graph
+        self.chunk_size = chunk_size
+        self._nodes = []
+        self._edges = []
+
+
+    def create(self, proxy, **kwargs):
+        data = {}
+        for name, prop in proxy._cls.properties.iteritems():
+            value = kwargs.pop(name, None)
+            if value is None:
+                value = prop.default
+            if value is None:
+                continue
+            data[name] = prop.coerce(name, value)
+
+        if kwargs:
+            raise AttributeError('Properties %r not allowed for %s' % (kwargs.keys(), proxy._cls.__name__))
+
+        node = _PendingNode(proxy._cls, self._g.names[proxy._cls], data)
+        self._nodes.append(node)
+        return node
+
+
+    def relate(self, rel_cls, outV, inV, **kwargs):
+        self._edges.append((rel_cls.__name__, outV, inV, kwargs))
+
+
+    def get_pending(self):
+        """ Returns the collected nodes and (label, outV, inV, data) tuples
+        of the collected relationships """
+        return self._nodes, self._edges
+
+
+    def flush(self):
+        """ Write all collected nodes, then all relationships. The eids of
+        the created nodes are set on the returned node objects """
+        self._g.backend.write_bulk(self._nodes, self._edges, self.chunk_size)
+
+        self._nodes = []
+        self._edges = []
+        self._g.cache.clear()
+        self._g.ancestors.clear()
+
+
+
 class Classes(dict):
     def __getattr__(self, name):
         return self[name]
@@ -357,30 +1278,32 @@ class Relationships(object):
 
 
 
-def init_graph(graph):
-    engine = 'neo4j'
-    #engine = 'rexster'
+def init_graph(graph, engine='neo4j', path='hwdb.sqlite'):
+    # path is only used by the local engine
+    if engine == 'local':
+        from localgraph import LocalBackend
+        graph.set_backend(LocalBackend(path))
 
-    if engine == 'rexster':
-        from bulbs.rexster import Graph as BulbsGraph, Config
-        url = 'http://localhost:8182/graphs/hwdbgraph'
-    elif engine == 'neo4j':
-        from bulbs.neo4jserver import Graph as BulbsGraph, Config
-        url = 'http://localhost:7474/db/data/'
     else:
-        raise Exception('Unknown engine %s' % engine)
+        if engine == 'rexster':
+            from bulbs.rexster import Graph as BulbsGraph, Config
+            url = 'http://localhost:8182/graphs/hwdbgraph'
+        elif engine == 'neo4j':
+            from bulbs.neo4jserver import Graph as BulbsGraph, Config
+            url = 'http://localhost:7474/db/data/'
+        else:
+            raise Exception('Unknown engine %s' % engine)
 
-    config = Config(url)
-    bg = BulbsGraph(config)
+        config = Config(url)
+        bg = BulbsGraph(config)
 
-    from logging import DEBUG, ERROR, FileHandler, NullHandler
-    bg.config.set_logger(ERROR, NullHandler)
+        from logging import DEBUG, ERROR, FileHandler, NullHandler
+        bg.config.set_logger(ERROR, NullHandler)
 
-    graph.set_bulbs_graph(bg)
+        graph.set_bulbs_graph(bg)
 
     for node_cls in get_node_classes():
         graph.register_class(node_cls)
 
     for name, rel_cls in R.iteritems():
-        bg.add_proxy(name, rel_cls)
-        rel_cls._bulbs_proxy = getattr(bg, name)
+        rel_cls._bulbs_proxy = graph.backend.add_relationship_class(name, rel_cls)
@@ -1,35 +1,50 @@
 #-*- coding: utf-8 -*-
 
+import os
+import sys
 import json
 import csv
+import hashlib
+import cPickle
+import inspect
+import multiprocessing
 from StringIO import StringIO
 
 FILE_SPLITTOR = '### <newfile> ###'
 
 
 def _inflate_meta_data(d):
-    for k in d.keys():
+    """ Returns a copy of d where tuple keys are replaced by one key for each
+    of their items """
+    inflated = {}
+    for k, v in d.iteritems():
         if isinstance(k, (list, tuple)):
-            v = d.pop(k)
             for sub_key in k:
-                d[sub_key] = v
+                inflated[sub_key] = v
+        else:
+            inflated[k] = v
+    return inflated
 
 
-def parse_csv(file_string, meta_data):
-    _inflate_meta_data(meta_data)
+def _normalize_name(name):
+    return name.replace('\n', ' ').replace('\xc2\xa0', ' ').strip(' \n\r\t\xa0\xc2') # xa0 and xc2 are nbsp
 
-    data = []
-    for row in csv.DictReader(StringIO(file_string)):
-        single_row_cols = {}
-        multi_row_cols = {}
-        for name, value in row.iteritems():
-            if value:
-                value = value.decode('utf-8').encode('ascii', 'replace') # TODO: evil codec bug
+
+class ColumnSchema(object):
+    """ The column definitions of a handler (meta_data) compiled for the
+    header row of a csv file. Header names are normalized and looked up only
+    once, transform() turns a row into the resulting dicts """
+
+    def __init__(self, header, meta_data):
+        meta_data = _inflate_meta_data(meta_data)
+        # list of (column index, name, multi, not_multi)
+        self.columns = []
+        for i, name in enumerate(header):
             if not name:
                 # seems to be an empty column
                 continue
 
-            name = name.replace('\n', ' ').replace('\xc2\xa0', ' ').strip(' \n\r\t\xa0\xc2') # xa0 and xc2 are nbsp
+            name = _normalize_name(name)
             try:
                 col_info = meta_data[name]
             except KeyError:
@@ -38,42 +53,69 @@ def parse_csv(file_string, meta_data):
             if col_info.get('ignore'):
                 continue
 
-            name = col_info.get('col', name)
-
-            if '\n' in value:
-                # check for illegal multirows
-                if col_info.get('multi'):
-                    multi_row_cols[name] = value.split('\n')
-                elif col_info.get('not_multi'):
-                    single_row_cols[name] = value.split('\n')
-                else:
-                    raise Exception()
-
-            else:
-                single_row_cols[name] = value
-
-        if multi_row_cols:
-
-            # Check if all multi_row_columns have the same number of rows
-            row_length_set = set((len(m) for m in multi_row_cols.values()))
-            if len(row_length_set) != 1:
-                # We cannot know how to handle a different number of rows
-                raise Exception()
+            self.columns.append((i, col_info.get('col', name), col_info.get('multi', False), col_info.get('not_multi', False)))
 
-            for i in xrange(row_length_set.pop()):
-                new_row = single_row_cols.copy()
-                for name, value_list in multi_row_cols.iteritems():
-                    new_row[name] = value_list[i]
-
-                data.append(new_row)
-
-        else:
-            data.append(single_row_cols)
-
-    return data
 
+    def transform(self, row):
+        """ Returns a list with the dict for row, or one dict per line if row
+        has columns with multiple lines """
+        single_row_cols = {}
+        multi_row_cols = {}
+        for i, name, multi, not_multi in self.columns:
+            value = row[i] if i < len(row) else ''
+            if value:
+                value = value.decode('utf-8').encode('ascii', 'replace') # TODO: evil codec bug
 
-def handle_DDR_SDRAM(file_string, url):
+                if '\n' in value:
+                    # check for illegal multirows
+                    if multi:
+                        multi_row_cols[name] = value.split('\n')
+                    elif not_multi:
+                        single_row_cols[name] = value.split('\n')
+                    else:
+                        raise Exception()
+                    continue
+
+            single_row_cols[name] = value
+
+        if not multi_row_cols:
+            return [single_row_cols]
+
+        # Check if all multi_row_columns have the same number of rows
+        row_length_set = set((len(m) for m in multi_row_cols.values()))
+        if len(row_length_set) != 1:
+            # We cannot know how to handle a different number of rows
+            raise Exception()
+
+        rows = []
+        for i in xrange(row_length_set.pop()):
+            new_row = single_row_cols.copy()
+            for name, value_list in multi_row_cols.iteritems():
+                new_row[name] = value_list[i]
+            rows.append(new_row)
+        return rows
+
+
+def parse_csv(lines, meta_data):
+    """ Yields the rows of the csv file, lines is an iterable of the lines of
+    the file or a string """
+    if isinstance(lines, basestring):
+        lines = StringIO(lines)
+
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return
+
+    schema = ColumnSchema(header, meta_data)
+    for row in reader:
+        if not row:
+            continue
+        for new_row in schema.transform(row):
+            yield new_row
+
+
+def handle_DDR_SDRAM(lines, url):
     timings = ('Timings (CL-tRCD-tRP)', 'Timings[2][3] (CL-tRCD-tRP)')
     cycle_time = ('Cycle time (ns)', 'Cycle time[4] (ns)')
     columns = {
@@ -89,7 +131,7 @@ def handle_DDR_SDRAM(file_string, url):
         'CAS latency (ns)':             dict(ignore=True),
     }
 
-    data = parse_csv(file_string, columns)
+    data = parse_csv(lines, columns)
     standards = []
     for row in data:
         row['Source'] = url
@@ -105,7 +147,7 @@ def handle_DDR_SDRAM(file_string, url):
     return dict(standards=standards)
 
 
-def handle_pentium4_willamette(file_string, url):
+def handle_pentium4_willamette(lines, url):
     columns = {
         'sSpec Number':             dict(col='S-Spec', not_multi=True),
         'Frequency':                dict(),
@@ -121,7 +163,7 @@ def handle_pentium4_willamette(file_string, url):
         'Model Number Clock Speed': dict(col='Name')
     }
 
-    data = parse_csv(file_string, columns)
+    data = parse_csv(lines, columns)
     parts = []
     connections = []
     for row in data:
@@ -153,25 +195,198 @@ handlers = {
     'Pentium4_Willamette': handle_pentium4_willamette,
 }
 
-def read_all_files(filepath):
-    f = open(filepath)
-    file_strings = f.read().split(FILE_SPLITTOR)
-    file_strings.pop(0) #remove the first empty item
-    all_files = {}
+def _is_empty(line):
+    return not line.strip(', \r\n\t')
+
+
+class _BundleReader(object):
+    """ Reads the files of a csv bundle line by line. The files are separated
+    by lines containing FILE_SPLITTOR, the first two lines of a file are its
+    name and url """
+
+    def __init__(self, f):
+        self._lines = iter(f)
+        self._at_separator = False
+
+
+    def _skip_to_separator(self):
+        for line in self._lines:
+            if FILE_SPLITTOR in line:
+                return True
+        return False
+
+
+    def _read_header(self):
+        header = []
+        for line in self._lines:
+            if FILE_SPLITTOR in line:
+                self._at_separator = True
+                return None
+            if not _is_empty(line):
+                header.append(line.strip(' #,\r\n'))
+                if len(header) == 2:
+                    return header
+        return None
+
+
+    def _iter_lines(self):
+        # Lines without content are held back until more content follows,
+        # so they are dropped at the end of a file
+        empty = []
+        for line in self._lines:
+            if FILE_SPLITTOR in line:
+                self._at_separator = True
+                return
+            if _is_empty(line):
+                empty.append(line)
+                continue
+            for empty_line in empty:
+                yield empty_line
+            empty = []
+            yield line
+
+
+    def __iter__(self):
+        """ Yields (name, url, lines) for every file. lines is an iterator
+        over the csv lines of the file, it has to be consumed before the
+        next file is read """
+        # Everything in front of the first separator is ignored
+        self._at_separator = self._skip_to_separator()
+        while self._at_separator:
+            self._at_separator = False
+            header = self._read_header()
+            if header is None:
+                continue
+            name, url = header
+            lines = self._iter_lines()
+            yield name, url, lines
+            # Skip the rest of the file if it was not consumed
+            for line in lines:
+                pass
+
+
+def _get_files(filepath):
+    """ Yields (name, url, lines) for every file with a handler """
+    with open(filepath, 'rU') as f:
+        for name, url, lines in _BundleReader(f):
+            if name in handlers:
+                print 'Parse', name
+                yield name, url, lines
+            else:
+                print 'no handler for', name
 
-    for file_string in file_strings:
-        file_string = file_string.strip(',\n')
 
-        lines = file_string.strip().splitlines()
-        name = lines[0].strip(' #,')
-        url = lines[1].strip(' #,')
-        handler = handlers.get(name)
-        if handler:
-            print 'Parse', name
-            all_files[name] = handler('\n'.join(lines[2:]), url)
-        else:
-            print 'no handler for', name
+def get_section_hash(name, url, lines):
+    h = hashlib.sha1()
+    h.update('%s\n%s\n' % (name, url))
+    for line in lines:
+        h.update(line)
+    return h.hexdigest()
 
-    return all_files
 
 
+def get_parser_version():
+    """ Hash of the source of this module, results of other versions of the
+    handlers are not taken from a SectionCache """
+    return hashlib.sha1(inspect.getsource(sys.modules[__name__])).hexdigest()
+
+
+
+class SectionCache(object):
+    """ The parse results of the csv files (sections) of the last successful
+    import with the hashes of their content, stored in a pickle file at path.
+    Unchanged sections need not be parsed again. The cache is empty if it was
+    written by another version of the parser """
+
+    def __init__(self, path, parser_version=None):
+        self.path = path
+        self.parser_version = parser_version or get_parser_version()
+        # name -> (hash, pickled parse result). The results are pickled right
+        # away because the import modifies them
+        self._sections = {}
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                cached = cPickle.load(f)
+            if isinstance(cached, tuple) and cached[0] == self.parser_version:
+                self._sections = cached[1]
+
+
+    def get(self, name, section_hash):
+        """ Returns the parse result of the section, None if it changed """
+        cached_hash, pickled = self._sections.get(name, (None, None))
+        return cPickle.loads(pickled) if cached_hash == section_hash else None
+
+
+    def set(self, name, section_hash, result):
+        self._sections[name] = (section_hash, cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+
+
+    def save(self):
+        """ Call after the parse results were imported successfully """
+        with open(self.path, 'wb') as f:
+            cPickle.dump((self.parser_version, self._sections), f, cPickle.HIGHEST_PROTOCOL)
+
+
+
+def _get_sections(filepath, cache, force_sections):
+    """ Yields (name, url, lines, hash, cached result) for every file with a
+    handler. Without a cache the lines are not read in advance and hash and
+    cached result are None """
+    for name, url, lines in _get_files(filepath):
+        if cache is None:
+            yield name, url, lines, None, None
+            continue
+
+        lines = list(lines)
+        section_hash = get_section_hash(name, url, lines)
+        result = None if name in force_sections else cache.get(name, section_hash)
+        if result is not None:
+            print 'Unchanged', name
+            lines = None
+        yield name, url, lines, section_hash, result
+
+
+def _parse_file(args):
+    name, url, lines, result = args
+    if result is None:
+        result = handlers[name](lines, url)
+    return name, result
+
+
+def read_all_files(filepath, jobs=1, cache=None, force_sections=()):
+    """ Parse all files in the csv bundle at filepath. The bundle is read line
+    by line and each file is parsed while it is read.
+
+    With jobs > 1 the files are parsed by a pool of jobs processes instead,
+    this needs the lines of the files which are waiting for a worker in
+    memory. The result is the same.
+
+    With a SectionCache files with the same content as in the cache are not
+    parsed, except those with a name in force_sections. The cache is updated
+    but not saved """
+    all_files = {}
+    sections = _get_sections(filepath, cache, force_sections)
+    hashes = []
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # imap() keeps the order of the files, later files with the same
+            # name replace earlier ones as in the sequential case
+            def _get_jobs():
+                for name, url, lines, section_hash, result in sections:
+                    hashes.append(section_hash)
+                    yield name, url, list(lines) if lines is not None else None, result
+            for i, (name, result) in enumerate(pool.imap(_parse_file, _get_jobs())):
+                all_files[name] = result
+                if cache is not None:
+                    cache.set(name, hashes[i], result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for name, url, lines, section_hash, result in sections:
+            name, result = _parse_file((name, url, lines, result))
+            all_files[name] = result
+            if cache is not None:
+                cache.set(name, section_hash, result)
+    return all_files
@@ -74,7 +74,9 @@ def export_xml(args):
 
 def start_ui(args):
     model.init_relationship_classes()
-    model.init_graph(model.g)
+    model.init_graph(model.g, args.engine, args.db_path)
+    model.g.cache.max_size = args.cache_size * 1024 * 1024
+    ui.snapshot_store.path = args.snapshot_path
     ui.app.debug = True
     ui.app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
     ui.app.secret_key = 'Todo'
@@ -92,10 +94,33 @@ def reset_db(args):
 
     #model.init_node_classes()
     model.init_relationship_classes()
-    model.init_graph(model.g)
+    model.init_graph(model.g, args.engine, args.db_path)
     model.g.clear()
     #g = db.init_graph() # must initialize a second time after clear, dont know why
-    db.reset_db(args.csv_path)
+    db.reset_db(args.csv_path, args.bulk, args.chunk_size, args.jobs, args.section_cache, args.force_sections)
+
+    print '== Build json snapshots =='
+    ui.snapshot_store.path = args.snapshot_path
+    ui.snapshot_store.rebuild()
+
+
+def sync_db(args):
+    model.init_relationship_classes()
+    model.init_graph(model.g, args.engine, args.db_path)
+    db.sync_db(args.csv_path, args.chunk_size, args.jobs, args.section_cache, args.force_sections)
+
+    print '== Build json snapshots =='
+    ui.snapshot_store.path = args.snapshot_path
+    ui.snapshot_store.rebuild()
+
+
+def migrate_values(args):
+    model.init_relationship_classes()
+    model.init_graph(model.g, args.engine, args.db_path)
+    db.migrate_typed_values()
+
+    ui.snapshot_store.path = args.snapshot_path
+    ui.snapshot_store.invalidate()
 
 
 COMMANDS = {
@@ -103,6 +128,8 @@ COMMANDS = {
     'ui': start_ui,
     'export_xml': export_xml,
     'reset_db': reset_db,
+    'sync_db': sync_db,
+    'migrate_values': migrate_values,
     'neo4jstart': start_neo4j,
     'neo4jstop': stop_neo4j,
 }
@@ -111,9 +138,18 @@ COMMANDS = {
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('command', choices=COMMANDS.keys(), help='Run one of the commands')
+    parser.add_argument('--engine', default='neo4j', choices=['neo4j', 'rexster', 'local'], help='Storage backend, local keeps the graph in a sqlite file')
+    parser.add_argument('--db_path', default='hwdb.sqlite', help='Path to the sqlite file (--engine local)')
     parser.add_argument('--neo4j_path', default='neo4j-community-1.8.1', help='Path to the neo4j directory')
     parser.add_argument('--force', action="store_true", help='Force yes on user input for the given command')
     parser.add_argument('--csv_path', default='/home/ben/projects/wikipedia-csv/csv/all.csv', help='Path to csv files')
+    parser.add_argument('--bulk', action="store_true", help='Collect all nodes in memory first and write them with batch requests (reset_db)')
+    parser.add_argument('--chunk_size', default=1000, type=int, help='Number of nodes or relationships per batch request (reset_db --bulk, sync_db)')
+    parser.add_argument('--jobs', default=1, type=int, help='Number of processes parsing the csv files (reset_db, sync_db)')
+    parser.add_argument('--section_cache', default=None, help='File with the parsed csv files of the last import, unchanged files are not parsed again (reset_db, sync_db). The cache is dropped when readcsv.py changes')
+    parser.add_argument('--force_section', dest='force_sections', action='append', default=[], help='Parse the csv file with this name even if it did not change, can be repeated')
+    parser.add_argument('--snapshot_path', default='snapshots', help='Directory for the prebuilt json trees')
+    parser.add_argument('--cache_size', default=64, type=int, help='Memory budget of the graph cache in MB')
 
     args = parser.parse_args()
 
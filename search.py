@@ -0,0 +1,95 @@
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+
+class AttributeIndex(object):
+    """ Parts by the values of their attributes, for filtering parts and
+    counting the values of the matching parts (facets).
+
+    rows are (part eid, part label, attr_type label, value, number), number
+    is the typed value of attributes with a numeric unit or None. Numbers are
+    kept sorted, so ranges are found with a binary search """
+
+    def __init__(self, rows):
+        self.numeric_attr_types = set()
+        # part eid -> part label
+        self._parts = {}
+        # part eid -> list of (attr_type label, value)
+        self._part_values = {}
+        # attr_type label -> value -> set of part eids
+        self._values = {}
+        # attr_type label -> sorted list of (number, part eid)
+        self._sorted = {}
+
+        for part_eid, part_label, attr_type, value, number in rows:
+            if number is not None:
+                self.numeric_attr_types.add(attr_type)
+                value = float(number)
+            else:
+                value = unicode(value)
+            self._parts[part_eid] = part_label
+            self._part_values.setdefault(part_eid, []).append((attr_type, value))
+            self._values.setdefault(attr_type, {}).setdefault(value, set()).add(part_eid)
+            if isinstance(value, float):
+                self._sorted.setdefault(attr_type, []).append((value, part_eid))
+
+        for l in self._sorted.itervalues():
+            l.sort()
+
+
+    def _get_equal(self, attr_type, value):
+        if attr_type in self.numeric_attr_types:
+            number = _to_number(value)
+            if number is not None:
+                value = number
+        return self._values.get(attr_type, {}).get(value, set())
+
+
+    def _get_range(self, attr_type, minimum=None, maximum=None):
+        l = self._sorted.get(attr_type, [])
+        start = 0 if minimum is None else bisect_left(l, (minimum, ))
+        end = len(l) if maximum is None else bisect_right(l, (maximum, float('inf')))
+        return set(part_eid for value, part_eid in l[start:end])
+
+
+    def search(self, equal=(), ranges=()):
+        """ equal is a list of (attr_type label, value), ranges a list of
+        (attr_type label, minimum, maximum) where a bound may be None. Returns
+        the matching parts as a list of (eid, label) sorted by label and the
+        facets as attr_type label -> list of (value, number of parts) """
+        matches = None
+        for attr_type, value in equal:
+            eids = self._get_equal(attr_type, value)
+            matches = eids if matches is None else matches & eids
+        for attr_type, minimum, maximum in ranges:
+            eids = self._get_range(attr_type, minimum, maximum)
+            matches = eids if matches is None else matches & eids
+        if matches is None:
+            matches = self._parts.viewkeys()
+
+        counts = {}
+        for part_eid in matches:
+            for attr_type, value in self._part_values[part_eid]:
+                attr_type_counts = counts.setdefault(attr_type, {})
+                attr_type_counts[value] = attr_type_counts.get(value, 0) + 1
+
+        parts = sorted(((eid, self._parts[eid]) for eid in matches), key=itemgetter(1))
+        facets = dict((attr_type, sorted(attr_type_counts.iteritems()))
+                      for attr_type, attr_type_counts in counts.iteritems())
+        return parts, facets
+
+
+
+def build_attribute_index(graph):
+    rows = []
+    for eid, value, number, attr_type, unit_eid, part_eid, part_label in graph.get_attribute_parts():
+        rows.append((part_eid, part_label, attr_type, value, number))
+    return AttributeIndex(rows)
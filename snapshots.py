@@ -0,0 +1,161 @@
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+from functools import partial
+from collections import OrderedDict
+from StringIO import StringIO
+
+
+
+def _compress(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+
+class Snapshot(object):
+    def __init__(self, data):
+        self.data = data
+        self.gzipped = _compress(data)
+        self.etag = hashlib.sha1(data).hexdigest()
+
+
+
+class SnapshotStore(object):
+    """ Serialized JSON trees which are built once and served until the store
+    is invalidated.
+
+    builder(name, *args) returns the object to serialize. If path is set the
+    snapshots are also written to this directory together with a version file,
+    so all ui processes pick up snapshots built by another process (i.e. after
+    `run.py reset_db`) and notice invalidations.
+
+    Snapshots with args (pages of a tree level, the connections of one
+    system) depend on request arguments. They are only kept in memory, at
+    most max_pages of them, the least recently used are dropped.
+
+    run_parallel(*funcs) returns the results of the functions, rebuild()
+    uses it to build the snapshots concurrently """
+
+    def __init__(self, builder, names, path=None, run_parallel=None, max_pages=1000):
+        self._builder = builder
+        self.names = names
+        self.path = path
+        self._run_parallel = run_parallel
+        self.max_pages = max_pages
+        self._snapshots = {}
+        self._pages = OrderedDict()
+        self._version = None
+
+
+    def _get_filename(self, key):
+        name = '-'.join(re.sub(r'\W', '_', str(k)) for k in key if k is not None)
+        return os.path.join(self.path, name + '.json')
+
+
+    def _read_version(self):
+        try:
+            with open(os.path.join(self.path, 'version')) as f:
+                return f.read()
+        except IOError:
+            return None
+
+
+    def _write(self, filename, data):
+        # Write to a temporary file first, so other processes never read
+        # partially written files
+        tmp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_filename, filename)
+
+
+    def _check_version(self):
+        if self.path is None:
+            return
+        version = self._read_version()
+        if version is None:
+            # First use of this directory
+            self.invalidate()
+        elif version != self._version:
+            self._snapshots.clear()
+            self._pages.clear()
+            self._version = version
+
+
+    def get(self, name, *args):
+        if name not in self.names:
+            raise ValueError('Unknown snapshot %r' % name)
+
+        self._check_version()
+        key = (name,) + args
+        if args:
+            return self._get_page(key)
+
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            return snapshot
+
+        filename = self._get_filename(key) if self.path is not None else None
+        if filename is not None and os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                snapshot = Snapshot(f.read())
+        else:
+            snapshot = Snapshot(json.dumps(self._builder(name, *args)))
+            if filename is not None:
+                self._write(filename, snapshot.data)
+
+        self._snapshots[key] = snapshot
+        return snapshot
+
+
+    def _get_page(self, key):
+        snapshot = self._pages.pop(key, None)
+        if snapshot is None:
+            snapshot = Snapshot(json.dumps(self._builder(*key)))
+        # Reinsert to mark the page as recently used
+        self._pages[key] = snapshot
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+        return snapshot
+
+
+    def get_version(self):
+        """ Changes whenever the store is invalidated, also by another process.
+        Other data derived from the graph can be rebuilt when it changes """
+        self._check_version()
+        return self._version
+
+
+    def invalidate(self):
+        """ Drop all snapshots, they will be rebuilt on the next request """
+        self._snapshots.clear()
+        self._pages.clear()
+        self._version = '%f-%s' % (time.time(), os.getpid())
+        if self.path is None:
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for filename in os.listdir(self.path):
+            if filename.endswith('.json'):
+                os.remove(os.path.join(self.path, filename))
+
+        self._write(os.path.join(self.path, 'version'), self._version)
+
+
+    def rebuild(self):
+        """ Invalidate and build the snapshots of all names without arguments """
+        self.invalidate()
+        funcs = [partial(self.get, name) for name in self.names]
+        if self._run_parallel is None:
+            for func in funcs:
+                func()
+        else:
+            self._run_parallel(*funcs)
@@ -0,0 +1,156 @@
+import copy
+import unittest
+from collections import Counter
+
+from model import g, init_relationship_classes, init_graph
+from db import get_typed_values
+import db
+import data
+
+
+def _init_graph():
+    # The graph is shared with test_ui, which initializes it on import
+    if not hasattr(g, 'backend'):
+        init_relationship_classes()
+        init_graph(g, 'local', ':memory:')
+        db.reset_db('')
+
+
+def _get_graph_content():
+    """ Returns the nodes and edges of g independent of their eids """
+    vertex_rows, edge_rows = g.get_graph_rows()
+    eids = [eid for eid, properties in vertex_rows]
+    indexes = dict((eid, i) for i, eid in enumerate(eids))
+    nodes = [(properties['element_type'], properties) for eid, properties in vertex_rows]
+    edges = [(label, indexes[out_eid], indexes[in_eid], edge_data)
+             for eid, label, out_eid, in_eid, edge_data in edge_rows]
+    keys = db._get_node_keys(nodes, edges)
+    return (Counter(keys),
+            Counter((label, keys[out_index], keys[in_index], db._freeze(edge_data))
+                    for label, out_index, in_index, edge_data in edges))
+
+
+
+class Test_TypedValues(unittest.TestCase):
+    def test_number(self):
+        self.assertEqual(get_typed_values('number', '2800'), dict(number=2800.0, date=None, flag=None))
+        self.assertEqual(get_typed_values('number', '1.1-1.5')['number'], None)
+
+    def test_date(self):
+        self.assertEqual(get_typed_values('date', 'November 20, 2000')['date'], '2000-11-20')
+        self.assertEqual(get_typed_values('date', '2001-01')['date'], None)
+
+    def test_bool(self):
+        self.assertEqual(get_typed_values('bool', 'Yes')['flag'], True)
+        self.assertEqual(get_typed_values('bool', False)['flag'], False)
+
+    def test_text(self):
+        self.assertEqual(get_typed_values(None, '2800'), dict(number=None, date=None, flag=None))
+
+
+
+class Test_ResetDb(unittest.TestCase):
+    def setUp(self):
+        _init_graph()
+
+    def test_bulk(self):
+        g.clear()
+        db.reset_db('', bulk=True)
+        bulk = _get_graph_content()
+
+        g.clear()
+        db.reset_db('')
+        self.assertEqual(bulk, _get_graph_content())
+        self.assertTrue(sum(bulk[0].values()) > 100)
+
+
+
+class Test_ImportSession(unittest.TestCase):
+    def setUp(self):
+        _init_graph()
+
+    def test_invalid_values(self):
+        # Nothing is written in bulk mode until flush()
+        session = db.ImportSession(bulk=True)
+        attr_type = g.AttrType.get_one(label='Column Address Strobe latency [CL]')
+        for value in ('2-2-2', '2.5-3-3', '3'):
+            session.get_attribute(value, attr_type)
+        self.assertEqual(session.invalid_values, {('Column Address Strobe latency [CL]', 'number'): 2})
+
+
+
+class Test_ImportSessionAttributes(unittest.TestCase):
+    def setUp(self):
+        _init_graph()
+        # Nothing is written in bulk mode until flush()
+        self.session = db.ImportSession(bulk=True)
+        self.frequency = g.AttrType.get_one(label='Frequency')
+        self.bus_speed = g.AttrType.get_one(label='Bus speed')
+
+    def test_same_attr_type(self):
+        attribute = self.session.get_attribute('12345', self.frequency)
+        self.assertIs(self.session.get_attribute('12345', self.frequency), attribute)
+        self.assertEqual(len(self.session.get_pending()[0]), 1)
+
+    def test_other_attr_type(self):
+        attribute = self.session.get_attribute('12345', self.frequency)
+        self.assertIsNot(self.session.get_attribute('12345', self.bus_speed), attribute)
+        self.assertEqual(len(self.session.get_pending()[0]), 2)
+
+    def test_existing(self):
+        (eid, value, attr_type_label) = g.get_attribute_keys()[0]
+        attr_type = g.AttrType.get_one(label=attr_type_label)
+        self.assertEqual(self.session.get_attribute(value, attr_type).eid, eid)
+        self.assertEqual(self.session.get_pending(), ([], []))
+
+
+
+class Test_ImportSessionLabels(unittest.TestCase):
+    def setUp(self):
+        _init_graph()
+
+    def test_preloaded(self):
+        part = g.Part.get_one(label='CPU')
+        session = db.ImportSession()
+        g.cache.clear()
+        # Labels are looked up in the preloaded table only
+        g.backend.lookup = lambda *args: self.fail('Index lookup %r' % (args, ))
+        try:
+            self.assertEqual(session.get_one(g.Part, 'CPU').eid, part.eid)
+            self.assertEqual(session.get_all(g.Part, 'Unknown part'), [])
+        finally:
+            del g.backend.lookup
+
+    def test_duplicate(self):
+        for bulk in (True, False):
+            session = db.ImportSession(bulk=bulk)
+            self.assertRaises(Exception, session.create, g.Part, label='CPU')
+        self.assertEqual(len(list(g.Part.get_all(label='CPU'))), 1)
+
+
+
+class Test_SyncDb(unittest.TestCase):
+    def setUp(self):
+        _init_graph()
+        self.data = dict((name, copy.deepcopy(getattr(data, name))) for name in ('units', 'standards', 'systems'))
+
+    def tearDown(self):
+        for name, value in self.data.iteritems():
+            setattr(data, name, value)
+        db.sync_db('')
+
+    def test_unchanged(self):
+        vertex_rows, edge_rows = g.get_graph_rows()
+        db.sync_db('')
+        self.assertEqual((sorted(vertex_rows), sorted(edge_rows)), tuple(map(sorted, g.get_graph_rows())))
+
+    def test_changed(self):
+        data.units[0]['note'] = 'Changed'
+        data.standards.append('Test standard')
+        data.systems.pop()
+        db.sync_db('')
+        synced = _get_graph_content()
+
+        g.clear()
+        db.reset_db('')
+        self.assertEqual(synced, _get_graph_content())
@@ -0,0 +1,129 @@
+from unittest import TestCase
+
+from bulbs.property import String, Integer
+
+from localgraph import LocalBackend
+
+
+
+class _Part(object):
+    properties = dict(
+        label = String(nullable=False),
+        quantity = Integer(),
+    )
+
+
+
+class Test_LocalBackend(TestCase):
+    def setUp(self):
+        self.backend = LocalBackend()
+        self.parts = self.backend.add_node_class('Part', _Part)
+        self.is_a = self.backend.add_relationship_class('IsA', None)
+
+
+    def test_create_and_lookup(self):
+        v = self.parts.create(label='CPU', quantity='2')
+        self.assertEqual(v.label, 'CPU')
+        self.assertEqual(v.quantity, 2)
+        self.assertEqual(self.parts.index.lookup('label', 'CPU'), [v])
+        self.assertEqual(self.parts.index.lookup('label', 'RAM'), [])
+        self.assertEqual(self.backend.get_vertex(v.eid)._data, dict(label='CPU', quantity=2, element_type='Part'))
+
+
+    def test_save(self):
+        v = self.parts.create(label='CPU')
+        v.label = 'RAM'
+        v.save()
+        self.assertEqual(self.parts.index.lookup('label', 'CPU'), [])
+        self.assertEqual(self.parts.index.lookup('label', 'RAM'), [v])
+
+
+    def test_not_nullable(self):
+        self.assertRaises(ValueError, self.parts.create)
+
+
+    def test_adjacent_and_delete(self):
+        parent = self.parts.create(label='Root')
+        child = self.parts.create(label='CPU')
+        self.is_a.create(child, parent)
+        self.assertEqual(parent.inV('IsA'), [child])
+        self.assertEqual(child.outV('IsA'), [parent])
+        self.assertEqual(child.outV('HasAttribute'), [])
+
+        self.backend.delete_vertex(child.eid)
+        self.assertEqual(parent.inV('IsA'), [])
+        self.assertEqual(self.backend.get_vertex(child.eid), None)
+
+
+    def test_subtree_rows(self):
+        root = self.parts.create(label='Root')
+        cpu = self.parts.create(label='CPU')
+        amd = self.parts.create(label='AMD')
+        self.is_a.create(cpu, root)
+        self.is_a.create(amd, cpu)
+
+        rows = sorted(self.backend.get_subtree_rows(root.eid, ['IsA']))
+        self.assertEqual(rows, [
+            (root.eid, cpu.eid, dict(label='CPU', element_type='Part')),
+            (cpu.eid, amd.eid, dict(label='AMD', element_type='Part')),
+        ])
+
+
+    def test_level_rows(self):
+        root = self.parts.create(label='Root')
+        cpu = self.parts.create(label='CPU')
+        amd = self.parts.create(label='AMD')
+        ram = self.parts.create(label='RAM')
+        self.is_a.create(cpu, root)
+        self.is_a.create(ram, root)
+        self.is_a.create(amd, cpu)
+
+        rows = self.backend.get_level_rows(root.eid, ['IsA'], None, None)
+        self.assertEqual([(eid, count) for eid, properties, count in rows], [(cpu.eid, 1), (ram.eid, 0)])
+        rows = self.backend.get_level_rows(root.eid, ['IsA'], None, 1)
+        self.assertEqual([eid for eid, properties, count in rows], [cpu.eid])
+        rows = self.backend.get_level_rows(root.eid, ['IsA'], ('CPU', cpu.eid), None)
+        self.assertEqual([eid for eid, properties, count in rows], [ram.eid])
+
+    def test_level_rows_same_label(self):
+        root = self.parts.create(label='Root')
+        first = self.parts.create(label='CPU')
+        second = self.parts.create(label='CPU')
+        self.is_a.create(first, root)
+        self.is_a.create(second, root)
+
+        rows = self.backend.get_level_rows(root.eid, ['IsA'], ('CPU', first.eid), None)
+        self.assertEqual([eid for eid, properties, count in rows], [second.eid])
+
+
+    def test_closure(self):
+        root = self.parts.create(label='Root')
+        cpu = self.parts.create(label='CPU')
+        amd = self.parts.create(label='AMD')
+        k7 = self.parts.create(label='K7')
+        self.is_a.create(amd, cpu)
+        self.is_a.create(k7, amd)
+        # Connects a subtree to the root
+        self.is_a.create(cpu, root)
+
+        rows = self.backend.get_descendant_rows(root.eid, None)
+        self.assertEqual([(eid, depth) for eid, properties, depth in rows], [(cpu.eid, 1), (amd.eid, 2), (k7.eid, 3)])
+        rows = self.backend.get_descendant_rows(root.eid, 2)
+        self.assertEqual([eid for eid, properties, depth in rows], [amd.eid])
+        self.assertEqual(self.backend.count_descendants(cpu.eid), 2)
+
+        self.backend.delete_vertex(amd.eid)
+        self.assertEqual(self.backend.count_descendants(root.eid), 1)
+        self.assertEqual(self.backend.count_descendants(k7.eid), 0)
+
+
+    def test_closure_rebuild(self):
+        root = self.parts.create(label='Root')
+        cpu = self.parts.create(label='CPU')
+        amd = self.parts.create(label='AMD')
+        self.is_a.create(cpu, root)
+        self.is_a.create(amd, cpu)
+        rows = self.backend.get_descendant_rows(root.eid, None)
+
+        self.backend._rebuild_closure()
+        self.assertEqual(self.backend.get_descendant_rows(root.eid, None), rows)
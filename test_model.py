@@ -1,10 +1,13 @@
+import socket
+import threading
 from unittest import TestCase, expectedFailure
 from logging import DEBUG
 
 from bulbs.property import String, Integer, DateTime, Bool
-from bulbs.model import Node as BulbsNode
+from bulbs.model import Node as BulbsNode, Relationship
 
-from model import Node, Properties, Graph
+from model import Node, Properties, CompactVertex, Graph, Subtree, AttributeMatrix, GraphCache, AncestorIndex, SystemConnections, BulbsBackend, _estimate_size
+from localgraph import LocalBackend
 
 
 
@@ -24,21 +27,24 @@ class MyNode3(Node):
     properties = dict()
 
 
-def init_test_graph(engine='neo4j'):
-    if engine == 'rexster':
-        from bulbs.rexster import Graph as BulbsGraph, Config
-        url = 'http://localhost:8182/graphs/hwdbgraph'
-    elif engine == 'neo4j':
-        from bulbs.neo4jserver import Graph as BulbsGraph, Config
-        url = 'http://localhost:7475/db/data/'
-    else:
-        raise Exception('Unknown engine %s' % engine)
-
-    config = Config(url)
-    bg = BulbsGraph(config)
+def init_test_graph(engine='local'):
     g = Graph()
-    g.set_bulbs_graph(bg)
-    #g.config.set_logger(DEBUG)
+    if engine == 'local':
+        g.set_backend(LocalBackend())
+    else:
+        if engine == 'rexster':
+            from bulbs.rexster import Graph as BulbsGraph, Config
+            url = 'http://localhost:8182/graphs/hwdbgraph'
+        elif engine == 'neo4j':
+            from bulbs.neo4jserver import Graph as BulbsGraph, Config
+            url = 'http://localhost:7475/db/data/'
+        else:
+            raise Exception('Unknown engine %s' % engine)
+
+        config = Config(url)
+        bg = BulbsGraph(config)
+        g.set_bulbs_graph(bg)
+        #g.config.set_logger(DEBUG)
 
     for node_cls in (MyNode, MyNode2, MyNode3):
         g.register_class(node_cls)
@@ -102,6 +108,14 @@ class Test_Node(TestCase):
         self.g.MyNode.create(prop1='y')
         self.assert_equal(self.g.MyNode.get_one(prop1='x'), node)
 
+    def test_get_one_with_property_matches(self):
+        node = self.g.MyNode.create(prop1='x')
+        self.g.MyNode.create(prop1='y')
+        self.g.MyNode.create(prop1='y')
+        self.assert_equal(self.g.MyNode.get_one(prop1='x'), node)
+        self.assertRaises(Exception, self.g.MyNode.get_one, prop1='z')
+        self.assertRaises(Exception, self.g.MyNode.get_one, prop1='y')
+
     def test_get_one_without_property(self):
         node = self.g.MyNode3.create()
         self.assert_equal(self.g.MyNode3.get_one(), node)
@@ -168,7 +182,7 @@ class Test_Node(TestCase):
 
 
     def test_update(self):
-        n = MyNode(None, BulbsNode(None), prop1='x')
+        n = MyNode(None, CompactVertex(None, 'MyNode', [None, None]), prop1='x')
         n.update(prop1='xx', prop2='y')
         self.assertEqual(n.P['prop1'], 'xx')
         self.assertEqual(n.P['prop2'], 'y')
@@ -214,22 +228,107 @@ class Test_Node(TestCase):
         res2 = self.g.get_from_eid(n.eid)
         self.assertIsInstance(res2, MyNode)
 
+    def test_save(self):
+        n = self.g.MyNode2.create(prop1='x', prop2=1)
+        self.assertIsInstance(n._vertex, CompactVertex)
+        n.P.prop2 = '2'
+        n.save()
+        # Coerced by the backend
+        self.assertEqual(n.P.prop2, 2)
+        self.assertEqual(self.g.backend.get_vertex(n.eid).prop2, 2)
+
+    def test_unsaved_changes(self):
+        n = self.g.MyNode2.create(prop1='x', prop2=1)
+        self.g.MyNode2.create(prop1='y', prop2=2)
+
+        node = self.g.get_from_eid(n.eid)
+        node.P.prop1 = 'dirty'
+        self.assertEqual(self.g.get_from_eid(n.eid).P.prop1, 'x')
+
+        node = self.g.get_from_eid(n.eid)
+        with self.assertRaises(ValueError):
+            node.update(prop1='xx', prop2=2)
+        self.assertEqual(self.g.get_from_eid(n.eid).P.prop1, 'x')
+
+        node.update(prop1='xx', prop2=3)
+        node.save()
+        self.assertEqual(self.g.get_from_eid(n.eid).P.prop1, 'xx')
+
+    def test_run_parallel(self):
+        n = self.g.MyNode.create(prop1='x')
+        self.g.start_identity_map()
+        try:
+            node = self.g.get_from_eid(n.eid)
+            results = self.g.run_parallel(
+                lambda: self.g.get_from_eid(n.eid),
+                lambda: self.g.run_parallel(lambda: 1, lambda: 2))
+        finally:
+            self.g.clear_identity_map()
+        # The identity map is shared with the threads of the pool
+        self.assertIs(results[0], node)
+        self.assertEqual(results[1], [1, 2])
+
+        self.assertRaises(ZeroDivisionError, self.g.run_parallel, lambda: 1, lambda: 1 / 0)
+
+
+class IsA(Relationship):
+    label = 'IsA'
+
+
+
+class Test_Descendants(TestCase):
+    """ The backends return the same results, see Test_Descendants_Neo4j """
+    engine = 'local'
+
+    def setUp(self):
+        self.g = init_test_graph(self.engine)
+        self.g.clear()
+        self.g = init_test_graph(self.engine)
+        is_a = self.g.backend.add_relationship_class('IsA', IsA)
+        self.root = self.g.MyNode.create(prop1='Root')
+        self.cpu = self.g.MyNode.create(prop1='CPU')
+        self.amd = self.g.MyNode.create(prop1='AMD')
+        is_a.create(self.cpu.eid, self.root.eid)
+        is_a.create(self.amd.eid, self.cpu.eid)
+
+    def _get_descendants(self, eid, depth=None):
+        return [(row_eid, depth) for row_eid, properties, depth in self.g.get_descendants(eid, depth)]
+
+    def test_descendants(self):
+        # Without the root itself
+        self.assertEqual(self._get_descendants(self.root.eid), [(self.cpu.eid, 1), (self.amd.eid, 2)])
+        self.assertEqual(self._get_descendants(self.amd.eid), [])
+        self.assertEqual(self._get_descendants(self.root.eid, 0), [(self.root.eid, 0)])
+        self.assertEqual(self._get_descendants(self.root.eid, 2), [(self.amd.eid, 2)])
+
+    def test_count_descendants(self):
+        self.assertEqual(self.g.count_descendants(self.root.eid), 2)
+        self.assertEqual(self.g.count_descendants(self.amd.eid), 0)
+
+
+
+class Test_Descendants_Neo4j(Test_Descendants):
+    engine = 'neo4j'
+
+    def setUp(self):
+        try:
+            super(Test_Descendants_Neo4j, self).setUp()
+        except socket.error:
+            self.skipTest('No neo4j test server')
+
+
 
 class Test_Properties(TestCase):
     def test_set_not_allowed(self):
-        properties = dict(
-            prop1 = String(nullable=False),
-            prop2 = Integer(unique=True),
-        )
-
-        p = Properties(BulbsNode(None), properties)
+        vertex = CompactVertex(None, 'MyNode2', [None, None])
+        p = Properties(vertex, MyNode2._property_indexes)
         self.assertIn('prop1', p)
         self.assertEqual(p.prop1, None)
 
         p.prop1 = 'x'
 
         self.assertEqual(p.prop1, 'x')
-        self.assertEqual(p._bnode.prop1, 'x')
+        self.assertEqual(vertex.values[MyNode2._property_names.index('prop1')], 'x')
 
         self.assertEqual(p['prop1'], 'x')
         p['prop1'] = 'y'
@@ -238,3 +337,160 @@ class Test_Properties(TestCase):
         with self.assertRaises(AttributeError) as e:
             p.unknown_prop = 'x'
 
+
+
+class Test_Subtree(TestCase):
+    def test_get_children(self):
+        rows = [
+            (1, 2, {'label': 'a'}),
+            (1, 3, {'label': 'b'}),
+            (3, 4, {'label': 'c'}),
+            (3, 4, {'label': 'c'}), # returned a second time for another path
+        ]
+        subtree = Subtree(1, rows)
+        self.assertEqual(subtree.get_children(), [(2, {'label': 'a'}), (3, {'label': 'b'})])
+        self.assertEqual(subtree.get_children(3), [(4, {'label': 'c'})])
+        self.assertEqual(subtree.get_children(4), [])
+
+
+class Test_AttributeMatrix(TestCase):
+    def test_matrix(self):
+        subtree = Subtree(1, [
+            (1, 2, {'label': 'a'}),
+            (2, 4, {'label': 'c'}),
+            (1, 3, {'label': 'b'}),
+        ])
+        attribute_rows = [
+            (2, 'Frequency', 100, 10),
+            (4, 'Frequency', 200, 10),
+            (4, 'Cores', 2, 11),
+        ]
+        matrix = AttributeMatrix(subtree, attribute_rows, {10: '%(unit)s MHz', 11: '%(unit)s'})
+        self.assertEqual([eid for eid, properties in matrix.parts], [2, 4, 3])
+        self.assertEqual(matrix.attr_types, ['Cores', 'Frequency'])
+        self.assertEqual(matrix.get_attributes(4), {'Frequency': '200 MHz', 'Cores': '2'})
+        self.assertEqual(matrix.get_attributes(3), {})
+
+
+class Test_GraphCache(TestCase):
+    def test_get_set(self):
+        cache = GraphCache()
+        self.assertEqual(cache.get(('vertex', 1)), None)
+        cache.set(('vertex', 1), 'x')
+        self.assertEqual(cache.get(('vertex', 1)), 'x')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        value = 'x' * 100
+        cache = GraphCache(max_size=_estimate_size(value) * 2)
+        cache.set(('vertex', 1), value)
+        cache.set(('vertex', 2), value)
+        cache.get(('vertex', 1)) # 2 is now the least recently used entry
+        cache.set(('vertex', 3), value)
+
+        self.assertEqual(cache.get(('vertex', 1)), value)
+        self.assertEqual(cache.get(('vertex', 2)), None)
+        self.assertEqual(cache.get(('vertex', 3)), value)
+        self.assertTrue(cache.size <= cache.max_size)
+
+    def test_invalidate_index(self):
+        cache = GraphCache()
+        cache.set(('index', 'Unit'), [1, 3])
+        cache.set(('index', 'Unit', 'label', 'MHz'), [1])
+        cache.set(('index', 'Part'), [2])
+        cache.set(('vertex', 1), 'x')
+
+        cache.invalidate_index('Unit')
+        self.assertEqual(cache.get(('index', 'Unit')), None)
+        self.assertEqual(cache.get(('index', 'Unit', 'label', 'MHz')), None)
+        self.assertEqual(cache.get(('index', 'Part')), [2])
+        self.assertEqual(cache.get(('vertex', 1)), 'x')
+
+    def test_invalidate_deleted_vertex(self):
+        cache = GraphCache()
+        cache.set(('vertex', 1), 'x')
+        cache.set(('adjacency', 1, 'in', 'IsA'), [2])
+        cache.set(('adjacency', 2, 'out', 'IsA'), [1])
+        cache.set(('adjacency', 2, 'out', 'IsUnit'), [3])
+        cache.set(('index', 'Unit'), [1, 3])
+
+        cache.invalidate_deleted_vertex(1)
+        self.assertEqual(cache.get(('vertex', 1)), None)
+        self.assertEqual(cache.get(('adjacency', 1, 'in', 'IsA')), None)
+        self.assertEqual(cache.get(('adjacency', 2, 'out', 'IsA')), None)
+        self.assertEqual(cache.get(('index', 'Unit')), None)
+        self.assertEqual(cache.get(('adjacency', 2, 'out', 'IsUnit')), [3])
+
+
+class Test_AncestorIndex(TestCase):
+    def test_build(self):
+        index = AncestorIndex()
+        self.assertEqual(index.get(3), None)
+        index.build([(3, 2), (2, 1), (4, 1)])
+        self.assertEqual(index.get(3), (1, 2))
+        self.assertEqual(index.get(4), (1, ))
+        self.assertEqual(index.get(1), ())
+        self.assertEqual(index.get(5), ())
+
+    def test_add_edge(self):
+        index = AncestorIndex()
+        index.build([(3, 2), (2, 1), (5, 4)])
+        # Moves the subtree of 2 below 5
+        index.add_edge(2, 5)
+        self.assertEqual(index.get(2), (4, 5))
+        self.assertEqual(index.get(3), (4, 5, 2))
+
+    def test_add_edge_old_parent(self):
+        index = AncestorIndex()
+        index.build([(2, 1), (5, 4)])
+        index.add_edge(2, 5)
+        # 2 is no child of 1 anymore, moving 1 does not change its path
+        index.add_edge(1, 6)
+        self.assertEqual(index.get(2), (4, 5))
+        self.assertEqual(index.get(1), (6, ))
+
+    def test_remove_vertex(self):
+        index = AncestorIndex()
+        index.build([(3, 2), (2, 1)])
+        index.remove_vertex(7)
+        self.assertEqual(index.get(3), (1, 2))
+        index.remove_vertex(2)
+        self.assertEqual(index.get(3), None)
+
+
+class Test_BulbsBackend(TestCase):
+    def test_credentials(self):
+        # Creating a bulbs graph needs a server, its client is enough here
+        from bulbs.config import Config
+        from bulbs.rest import Request
+        class _BulbsGraph(object):
+            class client(object):
+                request = Request(Config('http://localhost:7475/db/data/', username='user', password='secret'),
+                                  'application/json')
+        http = BulbsBackend(_BulbsGraph()).bg.client.request.http
+
+        # Each thread has its own Http, all with the credentials
+        https = []
+        thread = threading.Thread(target=lambda: https.append(http._get_http()))
+        thread.start()
+        thread.join()
+        https.append(http._get_http())
+        self.assertIsNot(https[0], https[1])
+        for h in https:
+            self.assertEqual(list(h.credentials.iter('')), [('user', 'secret')])
+
+
+
+class Test_SystemConnections(TestCase):
+    def test_add(self):
+        connections = SystemConnections()
+        connections.add(
+            connection_rows=[(1, 1, 10, 2, 3, 'RAM'), (1, 1, 11, 1, 4, 'Graphics card')],
+            via_rows=[(10, 5)],
+            connector_rows=[(1, 5, 'DIMM', 4), (1, 5, 'DIMM', 4)],
+            system_rows=[(4,)],
+        )
+        self.assertEqual([c['connector_eid'] for c in connections.get_connections(1, 1)], [5, None])
+        self.assertEqual(connections.get_connections(1, 3), [])
+        self.assertEqual(connections.get_connectors(1), [(5, 'DIMM', 4)])
+        self.assertEqual(connections.systems, set([4]))
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import readcsv
+from readcsv import read_all_files, parse_csv, SectionCache, FILE_SPLITTOR
+
+
+DDR_SDRAM = '''DDR_SDRAM,
+http://en.wikipedia.org/wiki/DDR_SDRAM,
+Standard name,Memory clock (MHz),Cycle time (ns),I/O bus clock (MHz),Data rate (MT/s),Module name,Peak transfer rate (MB/s),Timings (CL-tRCD-tRP),CAS latency (ns)
+DDR-200,100,10,100,200,PC-1600,1600,2-2-2,10
+,,,,,,,,
+'''
+
+DDR2_SDRAM = '''DDR2_SDRAM,
+http://en.wikipedia.org/wiki/DDR2_SDRAM,
+Standard name,Memory clock (MHz),Cycle time (ns),I/O bus clock (MHz),Data rate (MT/s),Module name,Peak transfer rate (MB/s),Timings (CL-tRCD-tRP),CAS latency (ns)
+"DDR2-400B
+DDR2-400C",100,10,200,400,PC2-3200,3200,"3-3-3
+4-4-4",15
+'''
+
+
+
+class Test_ReadAllFiles(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'all.csv')
+        with open(self.filename, 'w') as f:
+            for content in (DDR_SDRAM, 'Unknown,\nhttp://example.com,\na,b\n', DDR2_SDRAM):
+                f.write(FILE_SPLITTOR + '\n' + content)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read(self):
+        files = read_all_files(self.filename)
+        self.assertEqual(sorted(files), ['DDR2_SDRAM', 'DDR_SDRAM'])
+        names = [s['<name>'] for s in files['DDR2_SDRAM']['standards']]
+        self.assertEqual(names, ['DDR2-400B', 'DDR2-400C'])
+        # Trailing lines without content are no rows
+        self.assertEqual(len(files['DDR_SDRAM']['standards']), 1)
+
+    def test_parallel(self):
+        self.assertEqual(read_all_files(self.filename, jobs=2), read_all_files(self.filename))
+
+    def test_section_cache(self):
+        cache_path = os.path.join(self.path, 'sections.cache')
+        cache = SectionCache(cache_path)
+        files = read_all_files(self.filename, cache=cache)
+        cache.save()
+
+        calls = []
+        handler = readcsv.handlers['DDR_SDRAM']
+        readcsv.handlers['DDR_SDRAM'] = lambda lines, url: calls.append(url) or handler(lines, url)
+        try:
+            cache = SectionCache(cache_path)
+            self.assertEqual(files, read_all_files(self.filename, cache=cache))
+            self.assertEqual(files, read_all_files(self.filename, jobs=2, cache=cache))
+            self.assertEqual(len(calls), 0)
+
+            read_all_files(self.filename, cache=cache, force_sections=['DDR_SDRAM'])
+            self.assertEqual(len(calls), 1)
+
+            with open(self.filename, 'a') as f:
+                f.write(FILE_SPLITTOR + '\n' + DDR_SDRAM.replace('DDR-200', 'DDR-266'))
+            files = read_all_files(self.filename, cache=cache)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(files['DDR_SDRAM']['standards'][0]['<name>'], 'DDR-266')
+        finally:
+            readcsv.handlers['DDR_SDRAM'] = handler
+
+
+    def test_section_cache_parser_version(self):
+        cache_path = os.path.join(self.path, 'sections.cache')
+        cache = SectionCache(cache_path)
+        files = read_all_files(self.filename, cache=cache)
+        cache.save()
+        self.assertEqual(cache.parser_version, readcsv.get_parser_version())
+
+        section_hash = cache._sections['DDR_SDRAM'][0]
+        self.assertEqual(SectionCache(cache_path).get('DDR_SDRAM', section_hash), files['DDR_SDRAM'])
+        # Written by another version of the handlers
+        self.assertEqual(SectionCache(cache_path, parser_version='other').get('DDR_SDRAM', section_hash), None)
+
+
+
+class Test_ParseCsv(unittest.TestCase):
+    def test_parse(self):
+        columns = {
+            ('Name', 'Name[1]'): dict(col='name', multi=True),
+            'Size (MB)': dict(col='size'),
+            'Note': dict(ignore=True),
+        }
+        rows = list(parse_csv('Name[1],Size\xc2\xa0(MB),Note,\n"a\nb",12,x,\n\nc,,y,\n', columns))
+        self.assertEqual(rows, [
+            {'name': 'a', 'size': '12'},
+            {'name': 'b', 'size': '12'},
+            {'name': 'c', 'size': ''},
+        ])
+        # The column definitions are not modified
+        self.assertIn(('Name', 'Name[1]'), columns)
+
+    def test_unknown_column(self):
+        self.assertRaises(Exception, list, parse_csv('Name,Other\na,b\n', {'Name': dict()}))
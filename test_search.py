@@ -0,0 +1,43 @@
+import unittest
+
+from search import AttributeIndex
+
+
+
+class Test_AttributeIndex(unittest.TestCase):
+    def setUp(self):
+        rows = [
+            (1, 'Pentium 4', 'Frequency', '2800', 2800.0),
+            (1, 'Pentium 4', 'Vendor', 'Intel', None),
+            (2, 'Core 2', 'Frequency', '2900', 2900.0),
+            (2, 'Core 2', 'Vendor', 'Intel', None),
+            (3, 'Athlon', 'Frequency', '2000.0', 2000.0),
+            (3, 'Athlon', 'Vendor', 'AMD', None),
+            (4, 'Phenom', 'Vendor', 'AMD', None),
+        ]
+        self.index = AttributeIndex(rows)
+
+    def test_equal(self):
+        parts, facets = self.index.search([('Vendor', 'AMD')])
+        self.assertEqual(parts, [(3, 'Athlon'), (4, 'Phenom')])
+        self.assertEqual(facets, {'Vendor': [(u'AMD', 2)], 'Frequency': [(2000.0, 1)]})
+
+    def test_equal_numeric(self):
+        parts, facets = self.index.search([('Frequency', '2000')])
+        self.assertEqual(parts, [(3, 'Athlon')])
+
+    def test_range(self):
+        parts, facets = self.index.search(ranges=[('Frequency', 2000, 2800)])
+        self.assertEqual(parts, [(3, 'Athlon'), (1, 'Pentium 4')])
+        parts, facets = self.index.search(ranges=[('Frequency', 2850, None)])
+        self.assertEqual(parts, [(2, 'Core 2')])
+
+    def test_combined(self):
+        parts, facets = self.index.search([('Vendor', 'Intel')], [('Frequency', None, 2850)])
+        self.assertEqual(parts, [(1, 'Pentium 4')])
+        self.assertEqual(facets, {'Vendor': [(u'Intel', 1)], 'Frequency': [(2800.0, 1)]})
+
+    def test_no_filter(self):
+        parts, facets = self.index.search()
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(facets['Vendor'], [(u'AMD', 2), (u'Intel', 2)])
@@ -0,0 +1,93 @@
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from snapshots import SnapshotStore
+
+
+
+class Test_SnapshotStore(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _builder(self, name, *args):
+        self.calls.append((name,) + args)
+        return {'children': [name] + list(args)}
+
+    def test_built_once(self):
+        store = SnapshotStore(self._builder, ('parts',))
+        snapshot = store.get('parts')
+        self.assertEqual(json.loads(snapshot.data), {'children': ['parts']})
+        self.assertIs(store.get('parts'), snapshot)
+        self.assertEqual(self.calls, [('parts',)])
+
+    def test_gzipped(self):
+        store = SnapshotStore(self._builder, ('parts',))
+        snapshot = store.get('parts')
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(snapshot.gzipped)).read(), snapshot.data)
+
+    def test_unknown_name(self):
+        store = SnapshotStore(self._builder, ('parts',))
+        self.assertRaises(ValueError, store.get, 'unknown')
+
+    def test_invalidate(self):
+        store = SnapshotStore(self._builder, ('parts',))
+        store.get('parts')
+        store.invalidate()
+        store.get('parts')
+        self.assertEqual(self.calls, [('parts',), ('parts',)])
+
+    def test_version(self):
+        store = SnapshotStore(self._builder, ('parts',))
+        version = store.get_version()
+        self.assertEqual(store.get_version(), version)
+        store.invalidate()
+        self.assertNotEqual(store.get_version(), version)
+
+    def test_shared_path(self):
+        # A second process reuses the snapshots written by the first one
+        store1 = SnapshotStore(self._builder, ('parts', 'connections'), self.path)
+        store1.rebuild()
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'connections.json')))
+
+        store2 = SnapshotStore(self._builder, ('parts', 'connections'), self.path)
+        self.assertEqual(store2.get('parts').etag, store1.get('parts').etag)
+        store2.get('connections')
+        self.assertEqual(self.calls, [('parts',), ('connections',)])
+
+        # Invalidations of one process are noticed by the other one
+        store1.invalidate()
+        store2.get('parts')
+        self.assertEqual(self.calls[-1], ('parts',))
+        self.assertEqual(len(self.calls), 3)
+
+    def test_rebuild_parallel(self):
+        batches = []
+        def _run_parallel(*funcs):
+            batches.append(len(funcs))
+            return [func() for func in funcs]
+
+        store = SnapshotStore(self._builder, ('parts', 'connections'), run_parallel=_run_parallel)
+        store.rebuild()
+        self.assertEqual(batches, [2])
+        self.assertEqual(sorted(self.calls), [('connections',), ('parts',)])
+
+    def test_pages(self):
+        store = SnapshotStore(self._builder, ('parts',), self.path, max_pages=2)
+        store.get('parts', 1, 0)
+        store.get('parts', 2, 0)
+        store.get('parts', 1, 0)
+        store.get('parts', 3, 0) # drops the least recently used page 2
+        store.get('parts', 1, 0)
+        store.get('parts', 2, 0)
+        self.assertEqual(self.calls, [('parts', 1, 0), ('parts', 2, 0), ('parts', 3, 0), ('parts', 2, 0)])
+        # Pages are not written to the snapshot directory
+        self.assertEqual([f for f in os.listdir(self.path) if f.endswith('.json')], [])
@@ -146,3 +146,29 @@ class Test_inflate_tree(unittest.TestCase):
                   'A1': ['A11', 'A12']},
         }]
         self.assertRaises(MixedBracketsError, inflate_tree, t)
+
+
+    def test_duplicate_names(self):
+        t = ['A', {'B': ['A', 'C']}, 'C']
+        self.assertEqual(['A', 'C'], sorted(inflate_tree(t).duplicate_names))
+        self.assertRaises(Exception, inflate_tree, t, check_unique_names=True)
+
+
+    def test_import(self):
+        t = [{'A': {'<import>': 'csv', '<children>': ['A1']}}]
+        csv_files = {'csv': {'parts': [{'<name>': 'A2'}]}}
+        expected = [{'<name>': 'A', '<children>': [{'<name>': 'A1'}, {'<name>': 'A2'}]}]
+        self.assertEqual(expected, inflate_tree(t, csv_files, 'parts'))
+        # The tree is not modified
+        self.assertEqual([{'A': {'<import>': 'csv', '<children>': ['A1']}}], t)
+
+
+    def test_deep_tree(self):
+        t = ['X']
+        for i in xrange(5000):
+            t = [{'A%s' % i: t}]
+        result = inflate_tree(t, check_unique_names=True)
+        for i in xrange(5000):
+            (result, ) = result
+            result = result['<children>']
+        self.assertEqual([{'<name>': 'X'}], result)
@@ -2,12 +2,17 @@ import time
 import json
 import unittest
 
-from model import g, init_relationship_classes, init_graph
+from model import g, R, init_relationship_classes, init_graph
 import ui
+import db
 
 
-init_relationship_classes()
-init_graph(g)
+# The graph is shared with test_db
+if not hasattr(g, 'backend'):
+    init_relationship_classes()
+    init_graph(g, 'local', ':memory:')
+    # Import the parts, standards, etc. from data.py, no csv files needed
+    db.reset_db('')
 
 
 
@@ -59,6 +64,84 @@ class Test_UI(unittest.TestCase):
 
     def test_json_attributes(self):
         rv = self.app.get('/json?type=attributes')
+        attr_types = json.loads(rv.data)['children']
+        titles = [d['title'] for d in attr_types]
+        self.assertEqual(sorted(titles), titles)
+        # Only attributes shared by more than one part are listed
+        for attr_type in attr_types:
+            self.assertTrue(attr_type['title'].endswith(' [%s]' % len(attr_type['children'])))
+            for value in attr_type['children']:
+                self.assertTrue(len(value['children']) > 1)
+                self.assertTrue(value['title'].endswith(' [%s]' % len(value['children'])))
+
+        (l2_cache,) = [d for d in attr_types if d['title'].startswith('L2 cache ')]
+        self.assertEqual('L2 cache [3]', l2_cache['title'])
+        self.assertEqual([('1024 KB [2]', ['Prescott', 'Prescott (HT)']),
+                          ('2048 KB [2]', ['Cedar Mill', 'Prescott 2M']),
+                          ('512 KB [2]', ['Gallatin', 'Northwood'])],
+                         [(d['title'], d['children']) for d in l2_cache['children']])
+
+    def test_json_not_modified(self):
+        rv = self.app.get('/json?type=parts')
+        etag = rv.headers['ETag']
+        rv = self.app.get('/json?type=parts', headers={'If-None-Match': etag})
+        self.assertEqual(304, rv.status_code)
+
+    def test_json_gzip(self):
+        rv = self.app.get('/json?type=parts', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', rv.headers['Content-Encoding'])
+
+    def test_json_lazy(self):
+        rv = self.app.get('/json?type=parts&depth=1')
+        json_data = json.loads(rv.data)
+        self.assertEqual(None, json_data['cursor'])
+        (cpu,) = [d for d in json_data['children'] if d['title'] == 'CPU']
+        self.assertTrue(cpu['isLazy'])
+
+        rv = self.app.get('/json?type=parts&depth=1&parent=%s' % cpu['key'])
+        json_data = json.loads(rv.data)
+        self.assertEqual(cpu['childCount'], len(json_data['children']))
+
+    def test_json_lazy_pagination(self):
+        rv = self.app.get('/json?type=standards&depth=1')
+        expected = [d['key'] for d in json.loads(rv.data)['children']]
+
+        page_size = ui.PAGE_SIZE
+        keys = []
+        url = '/json?type=standards&depth=1'
+        try:
+            ui.PAGE_SIZE = 2
+            ui.snapshot_store.invalidate()
+            while True:
+                json_data = json.loads(self.app.get(url).data)
+                self.assertTrue(len(json_data['children']) <= 2)
+                keys += [d['key'] for d in json_data['children']]
+                if json_data['cursor'] is None:
+                    break
+                self.assertEqual(keys[-1], json_data['cursor'])
+                url = '/json?type=standards&depth=1&cursor=%s' % json_data['cursor']
+        finally:
+            ui.PAGE_SIZE = page_size
+            ui.snapshot_store.invalidate()
+        self.assertTrue(len(expected) > 2)
+        self.assertEqual(expected, keys)
+
+    def test_json_lazy_invalid(self):
+        for query in ('parent=x', 'parent=999999999', 'cursor=x', 'cursor=999999999'):
+            rv = self.app.get('/json?type=parts&depth=1&' + query)
+            self.assertIn(rv.status_code, (400, 404), query)
+
+    def test_search(self):
+        rv = self.app.get('/search?eq=Vendor:Intel&min=Frequency:2000&max=Frequency:3000')
+        json_data = json.loads(rv.data)
+        self.assertTrue(json_data['parts'])
+        self.assertEqual([{'value': 'Intel', 'count': len(json_data['parts'])}], json_data['facets']['Vendor'])
+        for facet in json_data['facets']['Frequency']:
+            self.assertTrue(2000 <= facet['value'] <= 3000)
+
+    def test_search_invalid(self):
+        rv = self.app.get('/search?min=Frequency:fast')
+        self.assertEqual(400, rv.status_code)
 
     def test_attr_types(self):
         rv = self.app.get('/schema/attr_types')
@@ -69,6 +152,82 @@ class Test_UI(unittest.TestCase):
         rv = self.app.get('/details?eid=%s&type=part' % part.eid)
         self.assertIn('Intel Pentium 4 2.80GHz 15.2.9', rv.data)
 
+    def test_graph_cache_invalidated(self):
+        self.app.get('/')
+        part = g.Part.get_one(label='Intel Pentium 4 2.80GHz 15.2.9')
+        part.get_ancestors()
+        self.assertTrue(g.cache.get(('vertex', part.eid)))
+
+        # As run.py reset_db does in another process
+        ui.snapshot_store.invalidate()
+        self.app.get('/')
+        self.assertEqual(g.cache.get(('vertex', part.eid)), None)
+        self.assertEqual(g.ancestors.get(part.eid), None)
+
+    def test_identity_map(self):
+        part = g.Part.get_one(label='Intel Pentium 4 2.80GHz 15.2.9')
+        self.assertIsNot(part, g.get_from_eid(part.eid))
+        g.start_identity_map()
+        try:
+            part = g.get_from_eid(part.eid)
+            self.assertIs(part, g.Part.get_one(label='Intel Pentium 4 2.80GHz 15.2.9'))
+            (parent, ) = part.outV('IsA')
+            self.assertIs(parent, g.get_from_eid(parent.eid))
+        finally:
+            g.clear_identity_map()
+        self.assertIsNot(part, g.get_from_eid(part.eid))
+
+    def test_ancestors(self):
+        part = g.Part.get_one(label='Intel Pentium 4 2.80GHz 15.2.9')
+        ancestors = part.get_ancestors()
+        self.assertEqual(g.RootPart.get_one().eid, ancestors[0].eid)
+        self.assertEqual('CPU', ancestors[1].P.label)
+        self.assertTrue(part.is_descendant_of(ancestors[1]))
+        self.assertFalse(ancestors[1].is_descendant_of(part))
+
+
+
+class Test_Connections(unittest.TestCase):
+    def setUp(self):
+        suffix = ' %r' % time.time()
+        self.board = g.Part.create(label='Test board' + suffix)
+        self.slot = g.Connector.create(label='Test slot' + suffix)
+        R.HasConnector.create(self.board, self.slot, quantity=2)
+        self.cards = [g.Part.create(label='Test card %s%s' % (i, suffix)) for i in range(3)]
+
+
+    def _connect(self, child):
+        connection = g.Connection.create(quantity=1)
+        R.BelongsTo.create(connection, self.board)
+        R.ConnectedFrom.create(self.board, connection)
+        R.ConnectedTo.create(connection, child)
+        R.ConnectedVia.create(connection, self.slot)
+
+
+    def test_slots(self):
+        self._connect(self.cards[0])
+        self._connect(self.cards[1])
+        (system, ) = ui._get_connections_json(self.board.eid)
+        slots = system['children']
+        self.assertEqual([slot['key'] for slot in slots], [self.slot.eid] * 2)
+        # Each card has a slot of its own
+        self.assertEqual(sorted(child['key'] for slot in slots for child in slot['children']),
+                         sorted(card.eid for card in self.cards[:2]))
+
+
+    def test_free_slot(self):
+        self._connect(self.cards[0])
+        (system, ) = ui._get_connections_json(self.board.eid)
+        self.assertEqual(sorted(len(slot['children']) for slot in system['children']), [0, 1])
+
+
+    def test_too_few_connectors(self):
+        for card in self.cards:
+            self._connect(card)
+        with self.assertRaises(Exception) as e:
+            ui._get_connections_json(self.board.eid)
+        self.assertIn('Too few connectors', str(e.exception))
+
 
 
 class Test_Unit(unittest.TestCase):
@@ -89,7 +248,7 @@ class Test_Unit(unittest.TestCase):
 
 
     def test_units_delete_allowed(self):
-        one_unit = g.Unit.create(label='testestest %s' % time.time(),
+        one_unit = g.Unit.create(label='testestest %r' % time.time(),
                                        name='xx', format='yy')
         rv = self.app.post('/schema/edit_units', data={'delete_form': one_unit.eid})
 
@@ -101,7 +260,7 @@ class Test_Unit(unittest.TestCase):
         data = {
             'action': 'new',
             'name': 'testesttest',
-            'label': 'testestest %s' % time.time(),
+            'label': 'testestest %r' % time.time(),
             'format': 'asdfasdfas',
             'note': 'asdfasdf',
         }
@@ -117,7 +276,7 @@ class Test_Unit(unittest.TestCase):
 
 
     def test_units_new_duplicate(self):
-        label = 'testestest %s' % time.time()
+        label = 'testestest %r' % time.time()
         one_unit = g.Unit.create(label=label, name='xx', format='yy')
 
         data = {
@@ -153,24 +312,24 @@ class Test_Unit(unittest.TestCase):
 
 
     def test_units_edit__different_label(self):
-        label = 'testestest %s' % time.time()
+        label = 'testestest %r' % time.time()
         one_unit = g.Unit.create(label=label, name='111', format='222', note='333')
-        different_label = 'tasdfasdfasdf %s' % time.time()
+        different_label = 'tasdfasdfasdf %r' % time.time()
         self._test_unit(different_label, one_unit.eid)
 
 
     def test_units_edit__same_label(self):
-        label = 'testestest %s' % time.time()
+        label = 'testestest %r' % time.time()
         one_unit = g.Unit.create(label=label, name='111', format='222', note='333')
         self._test_unit(label, one_unit.eid)
 
 
 
     def test_units_edit__duplicate_label(self):
-        other_label = 'other testestest %s' % time.time()
+        other_label = 'other testestest %r' % time.time()
         other_unit = g.Unit.create(label=other_label, name='111', format='222', note='333')
 
-        one_label = 'one testestest %s' % time.time()
+        one_label = 'one testestest %r' % time.time()
         one_unit = g.Unit.create(label=one_label, name='111', format='222', note='333')
 
         data = {
@@ -18,21 +18,49 @@ def keys_have_brackets(d):
     return bool(with_brackets)
 
 
-def inflate_tree(tree, csv_files=[], csv_label=None, check_unique_names=False):
+class InflatedTree(list):
+    """ The inflated elements returned by inflate_tree(). duplicate_names
+    lists the names which occur more than once in the tree """
+    def __init__(self):
+        super(InflatedTree, self).__init__()
+        self.duplicate_names = []
+
+
+
+# Keys of an element which contain lists of elements
+_LIST_KEYS = ('<children>', '<no_connector>', '<connectors>')
+
+
+def inflate_tree(tree, csv_files={}, csv_label=None, check_unique_names=False):
+    """ For examples see unit tests.
+
+    The tree is inflated in one pass without recursion. The dicts of the
+    elements and their lists are new, so the result can be modified without
+    changing tree. Elements from csv_files are added as they are. Raises
+    WrongTreeError if the tree is malformed and, with check_unique_names, an
+    Exception if a name occurs more than once """
+    result = InflatedTree()
     names = set()
 
     def _check_name(name):
-        if check_unique_names and name in names:
-            raise Exception('Found duplicate name: %r' % name)
+        if name in names:
+            result.duplicate_names.append(name)
         names.add(name)
 
+    # Tasks are (list of elements, list for the inflated elements) and
+    # (None, list of csv elements which are appended after the inflated
+    # elements). A stack keeps this order
+    stack = [(tree, result)]
+    while stack:
+        l, inflated_elements = stack.pop()
+        if l is None:
+            csv_elements, inflated_elements = inflated_elements
+            inflated_elements.extend(csv_elements)
+            continue
 
-    """ For examples see unit tests """
-    def _inflate_list(l):
         if not isinstance(l, (list, tuple)):
             raise Exception('Element %r is a %s but should be list/tuple'% (l, type(l)))
 
-        inflated_elements = []
         for el in l:
             if isinstance(el, basestring):
                 _check_name(el)
@@ -49,28 +77,26 @@ def inflate_tree(tree, csv_files=[], csv_label=None, check_unique_names=False):
                         inflated_el.update(v)
                         if not keys_have_brackets(inflated_el):
                             raise WrongTreeError('The keys in this dict must have brackets: %s; keys: %s'%(el, el.keys()))
-                        if '<children>' in inflated_el:
-                            if not isinstance(inflated_el['<children>'], (tuple, list)):
-                                raise WrongTreeError('Expected list, got type %s: %s'%(type(inflated_el['<children>']), inflated_el['<children>']))
-                            inflated_el['<children>'] = _inflate_list(inflated_el['<children>'])
-                        if '<no_connector>' in inflated_el:
-                            if not isinstance(inflated_el['<no_connector>'], (tuple, list)):
-                                raise WrongTreeError('Expected list, got type %s: %s'%(type(inflated_el['<no_connector>']), inflated_el['<no_connector>']))
-                            inflated_el['<no_connector>'] = _inflate_list(inflated_el['<no_connector>'])
-                        if '<connectors>' in inflated_el:
-                            if not isinstance(inflated_el['<connectors>'], (tuple, list)):
-                                raise WrongTreeError('Expected list, got type %s: %s'%(type(inflated_el['<connectors>']), inflated_el['<connectors>']))
-                            inflated_el['<connectors>'] = _inflate_list(inflated_el['<connectors>'])
+                        tasks = []
+                        for key in _LIST_KEYS:
+                            if key in inflated_el:
+                                if not isinstance(inflated_el[key], (tuple, list)):
+                                    raise WrongTreeError('Expected list, got type %s: %s'%(type(inflated_el[key]), inflated_el[key]))
+                                tasks.append((inflated_el[key], []))
+                                inflated_el[key] = tasks[-1][1]
                         if '<import>' in inflated_el:
                             name = inflated_el.pop('<import>')
                             if name in csv_files:
                                 if csv_label in csv_files[name]:
-                                    inflated_el.setdefault('<children>', []).extend(csv_files[name][csv_label])
+                                    children = inflated_el.setdefault('<children>', [])
+                                    stack.append((None, (csv_files[name][csv_label], children)))
                             else:
                                 print 'Warning: csv file part %s was not found, skipping import' % name
+                        stack.extend(tasks)
 
                     elif isinstance(v, list):
-                        inflated_el['<children>'] = _inflate_list(v)
+                        inflated_el['<children>'] = []
+                        stack.append((v, inflated_el['<children>']))
 
                     else:
                         raise WrongTreeError('%s %s' % (type(v), v))
@@ -80,6 +106,6 @@ def inflate_tree(tree, csv_files=[], csv_label=None, check_unique_names=False):
             else:
                 raise WrongTreeError(el)
 
-        return inflated_elements
-
-    return _inflate_list(tree)
+    if check_unique_names and result.duplicate_names:
+        raise Exception('Found duplicate name: %r' % result.duplicate_names[0])
+    return result
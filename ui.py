@@ -1,15 +1,29 @@
 import json
+from functools import partial
 from operator import itemgetter, methodcaller, attrgetter
 
-from flask import Flask, render_template, jsonify, request, Markup, redirect
+from flask import Flask, Response, render_template, jsonify, request, Markup, redirect, abort
 from flaskext.htmlbuilder import html as H
 
 from model import g
+from snapshots import SnapshotStore
+from search import build_attribute_index
 
 
 app = Flask(__name__)
 
 
+@app.before_request
+def _start_identity_map():
+    # Each vertex is fetched and wrapped only once per request
+    g.start_identity_map()
+
+
+@app.teardown_request
+def _clear_identity_map(exception=None):
+    g.clear_identity_map()
+
+
 @app.route('/')
 def index_view():
     return render_template('normal.html', heading='Index', content='')
@@ -25,8 +39,8 @@ def units_view():
     rows = []
     for unit in units:
         attr_types = []
-        for attr_type in unit._bulbs_node.inV('IsUnit') or []:
-            attr_types.append(attr_type.label)
+        for attr_type in unit.inV('IsUnit'):
+            attr_types.append(attr_type.P.label)
 
         rows.append(H.tr(
             H.td(unit.P.name),
@@ -86,7 +100,7 @@ def edit_units():
 
         if attr_types:
             content = H.div(
-                'Cannot delete unit, its used for %s' % ', '.join((a.label for a in attr_types)),
+                'Cannot delete unit, its used for %s' % ', '.join((a.P.label for a in attr_types)),
                 H.br, H.a(href='/schema/units')('Back'),
             )
         else:
@@ -102,7 +116,7 @@ def edit_units():
         return render_template('normal.html', heading='Really delete?', content=content)
 
     elif 'edit_form' in request.form:
-        unit = g.Unit.from_eid(request.form['edit_form'])
+        unit = g.get_from_eid(request.form['edit_form'])
         content = _mk_form(unit, 'edit', unit.eid)
         return render_template('normal.html', heading='Edit unit', content=content)
 
@@ -112,9 +126,10 @@ def edit_units():
 
 
     elif request.form.get('action') == 'delete':
-        unit = g.Unit.from_eid(request.form['eid'])
+        unit = g.get_from_eid(request.form['eid'])
         if unit:
             unit.delete()
+            snapshot_store.invalidate()
         return redirect('/schema/units')
 
     elif request.form.get('action') == 'edit':
@@ -124,6 +139,7 @@ def edit_units():
             return render_template('normal.html', heading='Edit unit', content=content)
         unit.update(request.form)
         unit.save()
+        snapshot_store.invalidate()
         return redirect('/schema/units')
 
     elif request.form.get('action') == 'new':
@@ -132,6 +148,7 @@ def edit_units():
             return render_template('normal.html', heading='Add unit', content=content)
 
         g.Unit.create(**dict(request.form.iteritems()))
+        snapshot_store.invalidate()
         return redirect('/schema/units')
 
     else:
@@ -143,15 +160,15 @@ def attr_types():
     rows = []
     attr_types = sorted(g.AttrType.get_all(), key=lambda el: el.P.label)
     for attr_type in attr_types:
-        (unit,) = attr_type._bulbs_node.outV('IsUnit')
+        (unit,) = attr_type.outV('IsUnit')
 
         parts = []
-        for part in attr_type._bulbs_node.inV('CanHaveAttrType') or []:
-            parts.append(part.label)
+        for part in attr_type.inV('CanHaveAttrType'):
+            parts.append(part.P.label)
 
         rows.append(H.tr(
             H.td(Markup(attr_type.P.label)), #TODO: using Markup is unsafe
-            H.td(unit.name),
+            H.td(unit.P.name),
             H.td(', '.join(parts)),
             H.td(attr_type.P.note)
         ))
@@ -169,7 +186,7 @@ def attr_types():
 
 def _create_render_tree_func(url, heading, datatype):
     def func():
-        return render_template('tree.html', heading=heading, datatype=datatype)
+        return render_template('tree.html', heading=heading, datatype=datatype, lazy=datatype in LAZY_TREES)
     app.add_url_rule(url, url.replace('/', '_'), func)
 
 _create_render_tree_func('/schema/parts', 'Part Schema', 'part_schema')
@@ -183,100 +200,95 @@ _create_render_tree_func('/schema/os', 'Operating Systems', 'os')
 
 
 def _get_connections_json(eid):
-    def _get_connections_for_part(connection_root_part, part):
-        # key=connecor.eid, value=list_of_connector_dicts
+    def _make_connector_dict(label, eid, children):
+        return {'title': label, 'key': eid, 'isFolder': True, 'children': children}
+
+    def _get_connections_for_part(system_eid, part_eid, part_label):
+        # key=connector.eid, value=[connector label, quantity, list of used connector dicts]
+        # The next free slot of a connector is the length of its list, empty
+        # slots are only created once all connections are assigned
         connectors = {}
 
         # list of dicts
         without_connectors = []
 
         # get all connectors that his part has
-        for has_connector in part.outE('has_connector') or []:
-            connector = has_connector.inV()
-            connectors[connector.eid] = []
-            for i in xrange(has_connector.quantity):
-                connector_dict = {'title': connector.label,
-                                  'key': connector.eid,
-                                  'isFolder': True,
-                                  'children': []}
-                connectors[connector.eid].append(connector_dict)
-
-        # get connected parts
-        for connection in part.outV('ConnectedFrom') or []:
-            # only follow connections which belong to this connection parent
-            (this_connection_root_part,) = connection.outV('BelongsTo')
-            if not this_connection_root_part == connection_root_part:
-                continue
-
-            # check if the connection has a connector
-            connected_via_list = connection.outE('connected_via')
-            if connected_via_list:
-                (connected_via,) = connected_via_list
-                connector_eid = connected_via.inV().eid
-            else:
-                connector_eid = None
-
-            # get the connected part
-            (childpart,) = connection.outV('ConnectedTo')
+        for connector_eid, connector_label, quantity in connections.get_connectors(part_eid):
+            connectors[connector_eid] = [connector_label, quantity, []]
 
-            child_dict = {'title': childpart.label, 'key': childpart.eid,}
+        # get connected parts, only connections which belong to this system
+        for connection in connections.get_connections(system_eid, part_eid):
+            child_eid = connection['child_eid']
+            child_label = connection['child_label']
+            child_dict = {'title': child_label, 'key': child_eid}
 
-            if childpart.outV('HasConnection'):
+            if child_eid in connections.systems:
                 # part is a connection root
-                child_dict['children'] = _get_connections_for_part(childpart, childpart)
+                child_dict['children'] = _get_connections_for_part(child_eid, child_eid, child_label)
             else:
-                child_dict['children'] = _get_connections_for_part(connection_root_part, childpart)
+                child_dict['children'] = _get_connections_for_part(system_eid, child_eid, child_label)
 
+            connector_eid = connection['connector_eid']
             if connector_eid is None:
                 without_connectors.append(child_dict)
-            else:
-                # associate each connected part with one connector
-                for i in xrange(connection.quantity):
-                    for connector in connectors[connector_eid]:
-                        if not connector['children']:
-                            connector['children'].append(child_dict)
-                            break
-                    else:
-                        raise Exception('Too few connectors')
-
-        flattened_connectors = []
-        for connectorList in connectors.values():
-            flattened_connectors.extend(connectorList)
-        result = flattened_connectors + without_connectors
+                continue
+
+            if connector_eid not in connectors:
+                raise Exception('%r is connected to %r via connector %s which %r does not have' % (
+                    child_label, part_label, connector_eid, part_label))
+
+            # associate each connected part with one connector
+            connector_label, quantity, used = connectors[connector_eid]
+            if len(used) + connection['quantity'] > quantity:
+                raise Exception('Too few connectors: %r has %s %r, but %s are needed' % (
+                    part_label, quantity, connector_label, len(used) + connection['quantity']))
+            for i in xrange(connection['quantity']):
+                used.append(_make_connector_dict(connector_label, connector_eid, [child_dict]))
+
+        result = []
+        for connector_eid, (connector_label, quantity, used) in connectors.iteritems():
+            result.extend(used)
+            for i in xrange(quantity - len(used)):
+                result.append(_make_connector_dict(connector_label, connector_eid, []))
+        result.extend(without_connectors)
         return sorted(result, key=methodcaller('get', 'title'))
 
 
-    l = []
     if eid:
-        part = g.get_from_eid(eid)
-        l.append({'title': part.P.label,
-                  'key': part.eid,
-                  'children': _get_connections_for_part(part._bulbs_node, part._bulbs_node),
-        })
+        systems = [g.get_from_eid(eid)]
     else:
         root = g.ConnectionRoot.get_one()
-        for part in root._bulbs_node.inV('HasConnection') or []:
-            l.append({'title': part.label,
-                      'key': part.eid,
-                      'children': _get_connections_for_part(part, part),
-            })
-        l.sort(key=itemgetter('title'))
+        systems = root.inV('HasConnection')
+
+    connections = g.get_connections([system.eid for system in systems])
+
+    l = []
+    for system in systems:
+        l.append({'title': system.P.label,
+                  'key': system.eid,
+                  'children': _get_connections_for_part(system.eid, system.eid, system.P.label),
+        })
+    l.sort(key=itemgetter('title'))
     return l
 
 
 def _get_attributes_json():
-    attr_types = {}
-    for attribute in g.Attribute.get_all():
-        parts = []
-        for part in attribute._bulbs_node.inV('HasAttribute'):
-            parts.append(part.label)
-        parts.sort()
+    # key=attribute eid, value=[attr_type label, formatted value, list of part labels]
+    attributes = {}
+    formats, attribute_parts = g.run_parallel(
+        lambda: dict((unit.eid, unit.P.format) for unit in g.Unit.get_all()),
+        g.get_attribute_parts)
+    for eid, value, number, attr_type_label, unit_eid, part_eid, part_label in attribute_parts:
+        if eid not in attributes:
+            attributes[eid] = [attr_type_label, formats[unit_eid] % {'unit': value}, []]
+        attributes[eid][2].append(part_label)
 
+    attr_types = {}
+    for attr_type_label, value, parts in attributes.itervalues():
         if len(parts) > 1:
-            (attr_type,) = attribute._bulbs_node.outV('HasAttrType')
-            (unit,) = attr_type.outV('IsUnit')
-            title = unit.format % {'unit': attribute.P.value} + ' [%s]' % len(parts)
-            attr_type_dict = attr_types.setdefault(attr_type.label, {'title': attr_type.label, 'children': []})
+            parts.sort()
+            title = value + ' [%s]' % len(parts)
+            attr_type_dict = attr_types.setdefault(attr_type_label, {'title': attr_type_label, 'children': []})
             attr_type_dict['children'].append({'title': title, 'children': parts})
 
     l = []
@@ -289,43 +301,87 @@ def _get_attributes_json():
     return l
 
 
-def _get_element_json(parent_el):
+def _build_tree_json(subtree, eid, make_dict):
+    # make_dict returns None for elements which should be skipped
+    # together with their children
     l = []
-    for element in parent_el._bulbs_node.inV('IsA') or []:
-        l.append({'title': element.label,
-                  'key': element.eid,
-                  'isFolder': hasattr(element, 'is_schema') and element.is_schema,
-                  'children': _get_element_json(g.Part(g, element))})
+    for child_eid, properties in subtree.get_children(eid):
+        d = make_dict(child_eid, properties)
+        if d is not None:
+            d['children'] = _build_tree_json(subtree, child_eid, make_dict)
+            l.append(d)
     l.sort(key=itemgetter('title'))
     return l
 
 
+def _get_element_json(parent_el):
+    def _make_dict(eid, properties):
+        return {'title': properties['label'],
+                'key': eid,
+                'isFolder': properties.get('is_schema', False)}
+
+    subtree = g.get_subtree(parent_el, ('IsA',))
+    return _build_tree_json(subtree, parent_el.eid, _make_dict)
+
+
 def _get_part_schema_json(parent_el):
-    l = []
-    for element in parent_el._bulbs_node.inV('IsA') or []:
-        if element.is_schema:
-            d = {'title': element.label, 'key': element.eid }
-            d['children'] = _get_part_schema_json(g.Part(g, element))
-            l.append(d)
-    l.sort(key=itemgetter('title'))
-    return l
+    def _make_dict(eid, properties):
+        if properties.get('is_schema'):
+            return {'title': properties['label'], 'key': eid}
+
+    subtree = g.get_subtree(parent_el, ('IsA',))
+    return _build_tree_json(subtree, parent_el.eid, _make_dict)
+
+
+def _get_connection_schema_json(parent_el):
+    # The first level is connected with 'IsAConnectionSchemaRoot' to the
+    # root, all other levels with 'CanBeContainedIn'
+    def _make_dict(eid, properties):
+        return {'title': properties['label'], 'key': eid}
+
+    subtree = g.get_subtree(parent_el, ('IsAConnectionSchemaRoot', 'CanBeContainedIn'))
+    return _build_tree_json(subtree, parent_el.eid, _make_dict)
 
 
-def _get_connection_schema_json(parent_el, edge_type):
-    # the function is called the first time with edge_type='IsAConnectionSchemaRoot'
-    # all inner calls have edge_type='CanBeContainedIn'
+# Trees which can be loaded level by level: root class, edge labels
+LAZY_TREES = {
+    'parts': ('RootPart', ('IsA', )),
+    'standards': ('RootStandard', ('IsA', )),
+    'connectors': ('RootConnector', ('IsA', )),
+    'os': ('RootOperatingSystem', ('IsA', )),
+    'connection_schema': ('ConnectionSchemaRoot', ('IsAConnectionSchemaRoot', 'CanBeContainedIn')),
+}
+
+# Maximal number of children in one response of a lazy tree
+PAGE_SIZE = 200
+
+
+def _get_level_json(data_type, parent_eid, cursor):
+    """ Returns the children of parent_eid following the child with the eid
+    cursor, or the first page if cursor is None. Elements with children are
+    marked as lazy, dynatree requests them on expansion. The returned cursor
+    is the eid of the last child on the page, None if this is the last page """
+    root_name, labels = LAZY_TREES[data_type]
+    after = None
+    if cursor is not None:
+        after = (g.get_from_eid(cursor).P.label, cursor)
+    rows = g.get_level(parent_eid, labels, after, PAGE_SIZE + 1)
+
     l = []
-    for element in parent_el._bulbs_node.inV(edge_type) or []:
-        d = {'title': element.label, 'key': element.eid }
-        d['children'] = _get_connection_schema_json(g.Part(g, element), 'CanBeContainedIn')
-        l.append(d)
-    l.sort(key=itemgetter('title'))
-    return l
+    for eid, properties, child_count in rows[:PAGE_SIZE]:
+        l.append({'title': properties['label'],
+                  'key': eid,
+                  'isFolder': properties.get('is_schema', False),
+                  'isLazy': child_count > 0,
+                  'childCount': child_count})
 
+    next_cursor = l[-1]['key'] if len(rows) > PAGE_SIZE else None
+    return {'children': l, 'cursor': next_cursor}
 
-@app.route('/json')
-def json():
-    data_type = request.args['type']
+
+def _get_tree_json(data_type, eid=None, level=False, cursor=None):
+    if level:
+        return _get_level_json(data_type, eid, cursor)
 
     if data_type == 'parts':
         root = g.RootPart.get_one()
@@ -349,10 +405,9 @@ def json():
 
     elif data_type == 'connection_schema':
         root = g.ConnectionSchemaRoot.get_one()
-        result = _get_connection_schema_json(root, 'IsAConnectionSchemaRoot')
+        result = _get_connection_schema_json(root)
 
     elif data_type == 'connections':
-        eid = request.args.get('eid')
         result = _get_connections_json(eid)
 
     elif data_type == 'attributes':
@@ -361,22 +416,137 @@ def json():
     else:
         raise ValueError()
 
-    return jsonify({'children': result})
+    # flask.jsonify denies sending json with an array as root
+    return {'children': result}
+
+
+snapshot_store = SnapshotStore(_get_tree_json, (
+    'parts', 'standards', 'connectors', 'os', 'part_schema',
+    'connection_schema', 'connections', 'attributes'), run_parallel=g.run_parallel)
+
+# [snapshot store version, AttributeIndex], rebuilt when the snapshots are
+# invalidated
+_attribute_index = [None, None]
+
+
+def _get_attribute_index():
+    version = snapshot_store.get_version()
+    if _attribute_index[1] is None or _attribute_index[0] != version:
+        _attribute_index[:] = [version, build_attribute_index(g)]
+    return _attribute_index[1]
+
+
+# Snapshot store version the graph cache was filled at
+_graph_version = [None]
+
+
+@app.before_request
+def _check_graph_version():
+    # reset_db, sync_db and migrate_values invalidate the snapshot store,
+    # also when they run in another process
+    version = snapshot_store.get_version()
+    if _graph_version[0] != version:
+        g.cache.clear()
+        g.ancestors.clear()
+        _graph_version[0] = version
+
+
+def _make_snapshot_response(snapshot):
+    if snapshot.etag in request.if_none_match:
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(snapshot.gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(snapshot.data, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _get_int_arg(name):
+    try:
+        return int(request.args.get(name))
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def _get_eid_arg(name):
+    """ The eid in the request argument name, which has to exist """
+    eid = _get_int_arg(name)
+    if g.get_from_eid(eid) is None:
+        abort(404)
+    return eid
+
+
+@app.route('/json')
+def json():
+    data_type = request.args['type']
+    if request.args.get('depth') == '1' and data_type in LAZY_TREES:
+        # One level of the tree, below the root if no parent is given
+        if request.args.get('parent'):
+            parent_eid = _get_eid_arg('parent')
+        else:
+            parent_eid = getattr(g, LAZY_TREES[data_type][0]).get_one().eid
+        cursor = _get_eid_arg('cursor') if request.args.get('cursor') else None
+        snapshot = snapshot_store.get(data_type, parent_eid, True, cursor)
+    elif data_type == 'connections' and request.args.get('eid'):
+        snapshot = snapshot_store.get(data_type, _get_eid_arg('eid'))
+    else:
+        snapshot = snapshot_store.get(data_type)
+    return _make_snapshot_response(snapshot)
+
+
+def _parse_search_args(name):
+    """ Split the values of the request argument name into (attr_type, value) """
+    l = []
+    for arg in request.args.getlist(name):
+        attr_type, sep, value = arg.partition(':')
+        if not sep:
+            abort(400)
+        l.append((attr_type, value))
+    return l
+
+
+@app.route('/search')
+def search():
+    """ Filter parts by their attributes, i.e.
+    /search?eq=Vendor:Intel&min=Frequency:2000&max=Frequency:3000
+    Returns the matching parts and the values of their attributes with the
+    number of parts having them """
+    ranges = {}
+    for bound, name in ((0, 'min'), (1, 'max')):
+        for attr_type, value in _parse_search_args(name):
+            try:
+                ranges.setdefault(attr_type, [None, None])[bound] = float(value)
+            except ValueError:
+                abort(400)
+
+    parts, facets = _get_attribute_index().search(
+        _parse_search_args('eq'),
+        [(attr_type, minimum, maximum) for attr_type, (minimum, maximum) in ranges.iteritems()])
+
+    return jsonify({
+        'parts': [{'title': label, 'key': eid} for eid, label in parts],
+        'facets': dict((attr_type, [{'value': value, 'count': count} for value, count in values])
+                       for attr_type, values in facets.iteritems()),
+    })
+
+
+@app.route('/stats/cache')
+def cache_stats():
+    return jsonify(g.cache.get_stats())
 
 
 @app.route('/details')
 def details():
     def _get_parents(element):
-        (parent,) = element.outV('IsA')
-        # Hacky hacky hacky patteng
-        if isinstance(parent, (g.RootConnector._bulbs_proxy.element_class,
-                               g.RootPart._bulbs_proxy.element_class,
-                               g.RootStandard._bulbs_proxy.element_class)):
+        # Labels of the ancestors below the first level and of the element,
+        # elements on the first level have none
+        ancestors = element.get_ancestors()
+        if len(ancestors) < 2:
             return []
-        else:
-            l = _get_parents(parent)
-            l.append(element.label)
-            return l
+        return [el.P.label for el in ancestors[2:]] + [element.P.label]
 
     def _render_breadcrumb(element):
         ul = []
@@ -392,10 +562,10 @@ def details():
 
     def _get_attributes(element):
         attr_dict = {}
-        for attribute in element.outV('HasAttribute') or []:
+        for attribute in element.outV('HasAttribute'):
             (attr_type,) = attribute.outV('HasAttrType')
             (unit,) = attr_type.outV('IsUnit')
-            attr_dict[attr_type.label] = unit.format % {'unit': attribute.value}
+            attr_dict[attr_type.P.label] = unit.P.format % {'unit': attribute.P.value}
         return attr_dict
 
 
@@ -411,37 +581,22 @@ def details():
 
     def _render_standards(element):
         lis = []
-        for standard in element.outV('Implements') or []:
-            lis.append(H.li(standard.label))
+        for standard in element.outV('Implements'):
+            lis.append(H.li(standard.P.label))
         lis.sort(key=str)
         if lis:
             return (H.h4('Standards'), H.ul(lis))
 
 
     def _render_subparts(element):
-        def _recursive_get_subparts(part):
-            parts = []
-            for subpart in part.inV('IsA') or []:
-                parts.append(subpart)
-                parts.extend(_recursive_get_subparts(subpart))
-            return parts
-
-        parts = _recursive_get_subparts(element)
-
-        found_attributes = set()
-        attributes = []
-        for part in parts:
-            attr_dict = _get_attributes(part)
-            found_attributes.update(attr_dict)
-            attributes.append(attr_dict)
-
-        sorted_attributes = sorted(found_attributes)
-        header_row = [H.th(name) for name in ['Name'] + sorted_attributes]
+        matrix = g.get_attribute_matrix(element)
+        header_row = [H.th(name) for name in ['Name'] + matrix.attr_types]
 
         rows = []
-        for part, attr_dict in zip(parts, attributes):
-            row = [H.td(part.label)]
-            for attr_name in sorted_attributes:
+        for eid, properties in matrix.parts:
+            attr_dict = matrix.get_attributes(eid)
+            row = [H.td(properties['label'])]
+            for attr_name in matrix.attr_types:
                 row.append(H.td(attr_dict.get(attr_name, None)))
             rows.append(H.tr(row))
 
@@ -451,20 +606,22 @@ def details():
 
 
     def _render_contained_parts(element):
-        if element.outE('HasConnection'):
+        if element.outV('HasConnection'):
             script = Markup('initTree("#containing_tree", "/json?type=connections&eid=%s");' % element.eid) # TODO: Unsafe?
             return (H.H3('Contained parts'), H.div(id='containing_tree')(H.script(script)))
 
 
     data_type = request.args['type']
     eid = request.args['eid']
-    element = g.get_from_eid(eid)._bulbs_node
-
-    breadcrumb = _render_breadcrumb(element)
-    attributes = _render_attributes(element)
-    standards = _render_standards(element)
-    contained_parts = _render_contained_parts(element)
-    subparts = _render_subparts(element)
+    element = g.get_from_eid(eid)
+
+    # The parts of the page need independent queries, they are sent in parallel
+    breadcrumb, attributes, standards, contained_parts, subparts = g.run_parallel(
+        partial(_render_breadcrumb, element),
+        partial(_render_attributes, element),
+        partial(_render_standards, element),
+        partial(_render_contained_parts, element),
+        partial(_render_subparts, element))
 
     content = (H.h4('Attributes'), attributes,
                H.h4('Standards'), standards, None)